@@ -0,0 +1,128 @@
+#!/usr/bin/python
+
+from os import path, remove, fdopen
+from optparse import OptionParser
+from tempfile import mkstemp
+from time import time
+
+from quakehordes.lexer import BuildQHDLLexer
+from quakehordes.scanner import QHDLScanner
+
+
+# Build a source of the requested size (in MB) by repeating the
+# sample sources
+def MakeSource(samples, size):
+    chunks = []
+    for sample in samples:
+        with open(sample, 'r') as f:
+            chunks.append(f.read())
+    chunk = '\n'.join(chunks) + '\n'
+    count = max(1, int(size*1024*1024) / len(chunk))
+    return chunk * count
+
+
+# Scan the whole input. Tokens are collected only when checking
+# that the scanners agree, so that timings measure the scanning
+def Tokens(lexer, collect=False):
+    tokens = []
+    count = 0
+    token = lexer.token
+    tok = token()
+    while tok is not None:
+        if collect:
+            tokens.append((tok.type, tok.value, tok.lineno,
+                           tok.lexpos))
+        count += 1
+        tok = token()
+    if collect:
+        return tokens
+    return count
+
+
+def TimeIt(label, func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time()
+        retVal = func()
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print '%-22s %8.3f s' % (label, best)
+    return best, retVal
+
+
+def ScanPLY(code, collect=False):
+    lexer = BuildQHDLLexer()
+    lexer.input(code)
+    return Tokens(lexer, collect)
+
+
+def ScanString(code, collect=False):
+    scanner = QHDLScanner()
+    scanner.input(code)
+    return Tokens(scanner, collect)
+
+
+def ScanFile(fileName, collect=False):
+    scanner = QHDLScanner()
+    scanner.inputFile(fileName)
+    try:
+        return Tokens(scanner, collect)
+    finally:
+        scanner.close()
+
+
+def ParseCmdLine():
+    usage = 'usage: QHDLBenchmark.py [options] [src.qh ...]'
+    cmdlineParser = OptionParser(usage=usage)
+    cmdlineParser.add_option('-s', '--size', type='float',
+                             default=10.0,
+                             help='size of the scanned source in MB',
+                             dest='size')
+    cmdlineParser.add_option('-r', '--repeat', type='int',
+                             default=3,
+                             help='runs for each measure (the best is reported)',
+                             dest='repeat')
+    return cmdlineParser.parse_args()
+
+
+def main():
+    options, samples = ParseCmdLine()
+    if not samples:
+        testsDir = path.join(path.dirname(path.realpath(__file__)),
+                             '..', 'tests')
+        samples = [path.join(testsDir, 'test%d.qh' % i)
+                   for i in range(1, 5)]
+
+    code = MakeSource(samples, options.size)
+    fd, fileName = mkstemp(suffix='.qh')
+    try:
+        with fdopen(fd, 'wb') as f:
+            f.write(code)
+
+        print 'Scanning %.1f MB (%d lines)' % \
+            (len(code)/(1024.0*1024.0), code.count('\n'))
+        plyTime, count = TimeIt('PLY lexer',
+                                lambda: ScanPLY(code),
+                                options.repeat)
+        strTime, count = TimeIt('QHDLScanner (string)',
+                                lambda: ScanString(code),
+                                options.repeat)
+        mapTime, count = TimeIt('QHDLScanner (mmap)',
+                                lambda: ScanFile(fileName),
+                                options.repeat)
+        print '%d tokens, speedup %.2fx (string), %.2fx (mmap)' % \
+            (count, plyTime/strTime, plyTime/mapTime)
+
+        # Finally, check that the scanners agree
+        plyTokens = ScanPLY(code, True)
+        if plyTokens != ScanString(code, True) or \
+                plyTokens != ScanFile(fileName, True):
+            print 'ERROR: scanners produced different tokens'
+            return 1
+    finally:
+        remove(fileName)
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -1,15 +1,31 @@
 #!/usr/bin/python
 
 import sys
-from os import mkdir, chdir, path, environ, listdir
-from subprocess import Popen, PIPE
+import re
+import struct
+from os import mkdir, makedirs, chdir, path, environ, listdir
+from os import remove
+from subprocess import Popen, PIPE, STDOUT
+from threading import Thread
+from time import time
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from functools import partial
 from optparse import OptionParser
 from datetime import datetime
 from shutil import copy2
+from distutils.spawn import find_executable
+try:
+    import resource
+except ImportError:
+    # Memory limits are not available on Windows
+    resource = None
 
 
 #from quakehordes import ENV, parser, Map
-from quakehordes import ENV, Map, BuildQHDLParser
+from quakehordes import Map, QHDLCompiler, ArtifactCache, HashContent
+from quakehordes import ParseMap, MapGeometry, EntityLump, \
+    PatchEntityLump
 from quakehordes import \
     QHDLLexError, QHDLSyntaxError, \
     QHDLTypeError, QHDLAttrError, QHDLIndexError, \
@@ -17,43 +33,373 @@ from quakehordes import \
 from quakehordes import initLogger, log
 
 
-def Build(_map):
-    # Obtain the .map code
-    if not _map.setup():
-        return False
-    outMap = str(_map)
-    
-    # Get the current platform and run the appropriate
-    # compiler
+# Stages of the map compilation, in the order they run: the
+# compiler options selecting the stage and its default options.
+# The bsp stage compiles the .map file, the following ones
+# work on the .bsp file
+STAGES = ['bsp', 'vis', 'light']
+STAGE_ARGS = {'bsp':[], 'vis':['-vis'], 'light':['-light']}
+STAGE_FLAGS = {'bsp':'', 'vis':'', 'light':'-extra4x4'}
+
+# Files produced by the map compiler
+ARTIFACTS = ('bsp', 'prt', 'lit')
+
+# Messages of the map compiler: counts (as "  1234 brushes", or
+# "   12 planes    240" with the size in bytes), the time taken
+# by a stage and the leaks of the map ("**** leaked ****")
+COUNT_MSG = re.compile(
+    r'^\s*(\d+)\s+([A-Za-z][A-Za-z ]*?)(?:\s+(\d+))?\s*$')
+TIME_MSG = re.compile(r'([0-9.]+) seconds elapsed')
+LEAK_MSG = re.compile(r'\*+\s*leaked\s*\*+')
+
+# Lines of the compiler output reported when a stage fails
+ERROR_LINES = 20
+
+# Seconds given to read the rest of the output of a compiler
+# which has exited (or has been killed)
+OUTPUT_GRACE = 1
+
+
+# Return the map compiler for the current platform, None if
+# the platform is not supported
+def CompilerExe():
     platform = sys.platform
     if platform == 'linux2':
-        exe = 'hmap2'
+        return 'hmap2'
     elif platform == 'win32':
-        exe = 'hmap2.exe'
-    else:
-        log('Unknown or unsupported platform [%s]' % \
-                platform, 'error')
+        return 'hmap2.exe'
+    log('Unknown or unsupported platform [%s]' % \
+            platform, 'error')
+    return None
+
+
+def Build(_map):
+    # Setup the map: its .map code is generated while saving it
+    if not _map.setup():
         return False
 
     # Save the compiled map
     with open(_map.name+'.map', 'w') as f:
-        f.write(outMap)
-
-    # Finally, compile map
-    pCompiler = Popen([exe, _map.name+'.map'],
-                      stdout=PIPE, stderr=PIPE)
-    pCompiler.wait()
-    pExit = pCompiler.communicate()
-
-    if pCompiler.returncode != 0:
-        # Map compilation fails!!!
-        log('Map compilation fails!!! Error:\nSTDOUT: %s\nSTDERR: %s' % \
-                (pExit[0], pExit[1]), 'error')
+        _map.write(f)
+    return True
+
+
+# Hash of the map compiler binaries, by path and modification
+# time
+_COMPILER_DIGESTS = {}
+
+def CompilerDigest(exe):
+    exePath = find_executable(exe)
+    if exePath is None:
+        return None
+    try:
+        stamp = (exePath, path.getmtime(exePath))
+        if stamp not in _COMPILER_DIGESTS:
+            with open(exePath, 'rb') as f:
+                _COMPILER_DIGESTS[stamp] = HashContent(f.read())
+    except (IOError, OSError):
+        return None
+    return _COMPILER_DIGESTS[stamp]
+
+
+# Return the keys of the output of each stage in the artifact
+# cache. The key of the first stage hashes the .map code, the
+# compiler and the stage options; the following ones hash the
+# previous key and the stage options, so that changing the
+# options of a stage keeps the output of the previous ones
+def StageKeys(exe, stages, code):
+    digest = CompilerDigest(exe)
+    if digest is None:
+        return [None] * len(stages)
+    key = HashContent(digest, code)
+    keys = []
+    for name, args in stages:
+        key = HashContent(key, name, '\0'.join(args))
+        keys.append(key)
+    return keys
+
+
+# Return the key of the geometry of a map, as compiled by the
+# given stages. None if the map can't be patched
+def GeometryKey(exe, stages, entities):
+    digest = CompilerDigest(exe)
+    if digest is None:
+        return None
+    lit = 'light' in [name for name, args in stages]
+    return HashContent(digest, repr(stages),
+                       MapGeometry(entities, lit))
+
+
+# Replace the entities of the .bsp file of a map if its geometry
+# is the one the file was compiled from. Return False if the
+# map must be compiled
+def PatchEntities(_map, geometry, entities):
+    try:
+        with open(_map.name+'.geo', 'r') as f:
+            if f.read() != geometry:
+                return False
+        return PatchEntityLump(_map.name+'.bsp',
+                               EntityLump(entities))
+    except (IOError, OSError, struct.error):
         return False
+
+
+# Result of the compilation of a map. If a stage fails, stage
+# is its name and returnCode the compiler exit code (None if the
+# compiler was killed for running too long); output holds the
+# compiler output of the last run. error describes the errors
+# which stopped the compilation before the compiler could run.
+# The compiler messages are collected by stage: the counts it
+# printed (and the sizes following them) and the time it
+# reported. times holds the wall-clock time taken by the stages
+# and attempts the compiler runs of each stage
+class CompileResult(object):
+
+    def __init__(self, _map):
+        self.map = _map
+        self.stage = None
+        self.returnCode = 0
+        self.error = None
+        self.output = []
+        self.counts = {}
+        self.sizes = {}
+        self.compilerTimes = {}
+        self.times = {}
+        self.attempts = {}
+        self.leaked = False
+        self.patched = False
+
+
+    @property
+    def success(self):
+        return self.returnCode == 0 and self.error is None
+
+
+    @property
+    def timedOut(self):
+        return self.returnCode is None
+
+
+    def parse(self, stage, line):
+        self.output.append(line)
+        m = COUNT_MSG.match(line)
+        if m is not None:
+            count, what, size = m.groups()
+            self.counts.setdefault(stage, {})[what] = int(count)
+            if size is not None:
+                self.sizes.setdefault(stage, {})[what] = int(size)
+            return
+        m = TIME_MSG.search(line)
+        if m is not None:
+            self.compilerTimes[stage] = float(m.group(1))
+        elif LEAK_MSG.search(line):
+            self.leaked = True
+
+
+# Log the compiler output as it is printed
+def ReadOutput(stream, result, stage):
+    for line in iter(stream.readline, ''):
+        line = line.rstrip()
+        log('[%s:%s] %s' % (result.map.name, stage, line), 'debug')
+        result.parse(stage, line)
+    stream.close()
+
+
+def LimitMemory(memLimit):
+    resource.setrlimit(resource.RLIMIT_AS, (memLimit, memLimit))
+
+
+# Run a compiler stage. The compiler is killed if it runs for
+# more than timeout seconds, and (where supported) it can't
+# allocate more than memLimit bytes. Return its exit code, None
+# if it was killed
+def RunStage(result, stage, cmd, timeout=None, memLimit=None):
+    if memLimit and resource is not None:
+        preexec = partial(LimitMemory, memLimit)
     else:
-        log('Map compilation success!!!', 'info')
+        preexec = None
+    result.output = []
+    pCompiler = Popen(cmd, stdout=PIPE, stderr=STDOUT,
+                      preexec_fn=preexec)
+    # The output is read by another thread, so that the compiler
+    # never blocks on a full pipe and can be timed meanwhile
+    reader = Thread(target=ReadOutput,
+                    args=(pCompiler.stdout, result, stage))
+    reader.daemon = True
+    reader.start()
+    # The compiler may keep running after closing its output:
+    # it's waited for by another thread too, until the deadline
+    waiter = Thread(target=pCompiler.wait)
+    waiter.daemon = True
+    waiter.start()
+    if timeout is not None:
+        deadline = time() + timeout
+    for thread in (reader, waiter):
+        if timeout is None:
+            thread.join()
+        else:
+            thread.join(max(deadline - time(), 0))
+    killed = waiter.is_alive()
+    if killed:
+        # Runaway compiler: killing it closes the pipe
+        pCompiler.kill()
+        waiter.join()
+    # The compiler may be done while its output is still read
+    reader.join(OUTPUT_GRACE)
+    if killed:
+        return None
+    return pCompiler.returncode
 
-    return True
+
+# Run the compilation stages on a saved map, starting from the
+# output of the last stage found in the cache (if any). stages
+# lists the name and the compiler options of each stage. If
+# patchEntities is set and only the point entities of the map
+# changed since the previous build, the compiled map is patched
+# instead. limits holds the time (in seconds) the compilation
+# of the map can take, the memory limit (in bytes) of each
+# compiler run, and how many times the runs killed by a signal
+# are retried. Return the CompileResult of the map: errors are
+# recorded there, so that they don't stop the other maps
+def Compile(exe, stages, cache, patchEntities, limits, _map):
+    result = CompileResult(_map)
+    try:
+        CompileStages(result, exe, stages, cache, patchEntities,
+                      limits)
+    except Exception, e:
+        result.error = '%s: %s' % (e.__class__.__name__, e)
+    return result
+
+
+def CompileStages(result, exe, stages, cache, patchEntities, limits):
+    _map = result.map
+    if limits['timeout']:
+        deadline = time() + limits['timeout']
+    else:
+        deadline = None
+    with open(_map.name+'.map', 'rb') as f:
+        code = f.read()
+
+    geometry = None
+    if patchEntities:
+        startTime = time()
+        entities = ParseMap(code)
+        if entities is not None:
+            geometry = GeometryKey(exe, stages, entities)
+        else:
+            log("Map [%s] code can't be parsed: it is fully compiled" % \
+                    _map.name, 'warning')
+        if geometry is not None and \
+                PatchEntities(_map, geometry, entities):
+            log('Map [%s] entities patched in %.3f s' % \
+                    (_map.name, time()-startTime), 'info')
+            result.patched = True
+            return
+
+    if cache is not None:
+        keys = StageKeys(exe, stages, code)
+    else:
+        keys = [None] * len(stages)
+
+    # Remove the output of previous builds
+    for ext in ARTIFACTS + ('geo',):
+        fileName = _map.name + '.' + ext
+        if path.exists(fileName):
+            remove(fileName)
+
+    # Each map counts as one cache hit or miss
+    first = 0
+    if keys[-1] is not None:
+        cached = [i for i in range(len(stages))
+                  if cache.contains(keys[i])]
+        if not cached:
+            cache.missed()
+        elif cache.restore(keys[cached[-1]], _map.name):
+            log('Map [%s] stage [%s] restored from cache' % \
+                    (_map.name, stages[cached[-1]][0]), 'info')
+            first = cached[-1] + 1
+
+    for i in range(first, len(stages)):
+        name, args = stages[i]
+        if i == 0:
+            target = _map.name + '.map'
+        else:
+            target = _map.name + '.bsp'
+        startTime = time()
+        retCode = None
+        for attempt in range(1, limits['retries']+2):
+            # Each stage gets the time left to the map
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time()
+                if timeout <= 0:
+                    break
+            result.attempts[name] = attempt
+            retCode = RunStage(result, name, [exe] + args + [target],
+                               timeout, limits['memory'])
+            if retCode is None:
+                log('Map [%s] stage [%s] killed: the map compilation takes more than %s s' % \
+                        (_map.name, name, limits['timeout']),
+                    'warning')
+                break
+            elif retCode >= 0:
+                break
+            log('Map [%s] stage [%s] killed by signal %d (attempt %d)' % \
+                    (_map.name, name, -retCode, attempt), 'warning')
+        result.times[name] = time() - startTime
+        if name in result.compilerTimes:
+            log('Map [%s] stage [%s] done in %.2f s (%.2f s reported by the compiler)' % \
+                    (_map.name, name, result.times[name],
+                     result.compilerTimes[name]), 'info')
+        else:
+            log('Map [%s] stage [%s] done in %.2f s' % \
+                    (_map.name, name, result.times[name]), 'info')
+        if name in result.counts:
+            counts = []
+            for what, count in sorted(result.counts[name].items()):
+                size = result.sizes.get(name, {}).get(what)
+                if size is None:
+                    counts.append('%d %s' % (count, what))
+                else:
+                    counts.append('%d %s (%d bytes)' % \
+                                      (count, what, size))
+            log('Map [%s] stage [%s] counts: %s' % \
+                    (_map.name, name, ', '.join(counts)), 'info')
+        if retCode != 0:
+            result.stage = name
+            result.returnCode = retCode
+            return
+        if keys[i] is not None:
+            cache.store(keys[i], _map.name)
+
+    # Record the geometry the .bsp file was compiled from
+    if geometry is not None:
+        with open(_map.name+'.geo', 'w') as f:
+            f.write(geometry)
+
+
+# Compile the saved maps running up to jobs compilers at once.
+# Results are yielded as soon as each map is compiled
+def CompileMaps(exe, stages, cache, patchEntities, limits, maps,
+                jobs=1):
+    if jobs <= 1 or len(maps) <= 1:
+        for _map in maps:
+            yield Compile(exe, stages, cache, patchEntities, limits,
+                          _map)
+        return
+
+    # The compilers are external processes: threads are enough
+    # to wait for them
+    pool = ThreadPool(min(jobs, len(maps)))
+    try:
+        for result in pool.imap_unordered(
+            partial(Compile, exe, stages, cache, patchEntities,
+                    limits),
+            maps):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
 
 
 def Install(_map, installPath):
@@ -102,55 +448,120 @@ def ParseCmdLine():
     cmdlineParser.add_option('-W', '--work-dir',
                              help='working directory',
                              dest='workDir')
-    return cmdlineParser.parse_args()
+    cmdlineParser.add_option('-v', '--verbose',
+                             action='store_true', default=False,
+                             help='report the optimizations done on the sources',
+                             dest='verbose')
+    cmdlineParser.add_option('-j', '--jobs', type='int',
+                             help='build the sources on N worker processes (0 for one for each CPU)',
+                             metavar='N', dest='jobs')
+    cmdlineParser.add_option('--compile-jobs', type='int',
+                             help='compile up to N maps of a source at once (0 for one for each CPU, the default without --jobs, 1 with it)',
+                             metavar='N', dest='compileJobs')
+    cmdlineParser.add_option('--stages', default='bsp',
+                             help='comma separated compilation stages to run, among %s (default bsp)' % \
+                                 ', '.join(STAGES),
+                             dest='stages')
+    for name in STAGES:
+        cmdlineParser.add_option('--%s-flags' % name,
+                                 default=STAGE_FLAGS[name],
+                                 help='options of the %s stage (default "%s")' % \
+                                     (name, STAGE_FLAGS[name]),
+                                 metavar='FLAGS', dest='%sFlags' % name)
+    cmdlineParser.add_option('--compile-timeout', type='float',
+                             help='kill the map compiler when a map takes more than SECONDS to compile',
+                             metavar='SECONDS', dest='compileTimeout')
+    cmdlineParser.add_option('--compile-memory', type='int',
+                             help='limit the memory of the map compiler to MB (not on Windows)',
+                             metavar='MB', dest='compileMemory')
+    cmdlineParser.add_option('--compile-retries', type='int',
+                             default=1,
+                             help='times a map compiler stage killed by a signal is run again (default 1)',
+                             metavar='N', dest='compileRetries')
+    cmdlineParser.add_option('--full-compile',
+                             action='store_false', default=True,
+                             help='compile the maps even if only their point entities changed',
+                             dest='patchEntities')
+    cmdlineParser.add_option('--bsp-cache-size', type='int',
+                             default=ArtifactCache.DEFAULT_SIZE/(1024*1024),
+                             help='size of the compiled maps cache in MB (0 to disable it)',
+                             metavar='MB', dest='bspCacheSize')
+    cmdlineParser.add_option('--resolve-overlaps',
+                             action='store_true', default=False,
+                             help='move the entities overlapping other ones to the nearest free place',
+                             dest='resolveOverlaps')
+    cmdlineParser.add_option('--merge-brushes',
+                             action='store_true', default=False,
+                             help='merge the adjacent world brushes into larger boxes before compiling the maps',
+                             dest='mergeBrushes')
+    options, args = cmdlineParser.parse_args()
 
+    # Stages run in their order, starting from the bsp one
+    names = options.stages.split(',')
+    if names[0] != 'bsp' or \
+            [name for name in STAGES if name in names] != names:
+        cmdlineParser.error('invalid stages [%s]' % options.stages)
+    options.stages = [(name,
+                       STAGE_ARGS[name] + \
+                           getattr(options, '%sFlags' % name).split())
+                      for name in names]
+    return options, args
 
-# TO DO: how manage build errors?
-def main():
-    cmdLineArgs = ParseCmdLine()
-    sources = cmdLineArgs[1]
-    installPath = cmdLineArgs[0].installPath
-    workDir = cmdLineArgs[0].workDir
 
-    builtMaps = 0
-    for src in sources:
-      i = 1
-      try:
-        # Parse and execute each specified file
-        with open(src, 'r') as f:
-
-            # Move to working dir. If no working dir is
-            # specified, create a new one
-            currDir = path.realpath(path.curdir)
-            if workDir is None:
-                workDir = path.join(path.curdir, 'tmp')
-            if not path.exists(workDir):
-                mkdir(workDir)
-            workDir = path.realpath(workDir)
-            chdir(workDir)
+# Create a directory, which may be created meanwhile by another
+# worker
+def MakeDir(dirName):
+    try:
+        makedirs(dirName)
+    except OSError:
+        if not path.isdir(dirName):
+            raise
 
+
+# Parse and execute a source file, then build (and install) the
+# maps it defines. The build runs in workDir. Return the result
+# of the build as a dictionary holding the source name, the
+# report for the user, the errors and the names of the built maps
+def BuildSource(compiler, src, workDir, installPath=None,
+                verbose=False, resolveOverlaps=False,
+                compileJobs=1, bspCacheSize=0, stages=None,
+                patchEntities=False, limits=None, mergeBrushes=False):
+    if stages is None:
+        stages = [('bsp', [])]
+    if limits is None:
+        limits = {'timeout':None, 'memory':None, 'retries':0}
+    result = {'source':src, 'output':[], 'errors':[], 'maps':[]}
+    i = 1
+    # Sources are read after moving to the working dir
+    srcPath = path.realpath(src)
+    currDir = path.realpath(path.curdir)
+    try:
+        MakeDir(workDir)
+        chdir(workDir)
+        try:
             #print "Parse [%s]" % src
             # Start the parsing of the file
-            code = ''.join([line for line in f])
-            parser = BuildQHDLParser(workDir)
             try:
-                ast = parser.parse(code, tracking=True)
+                ast = compiler.parseFile(srcPath)
+                if verbose:
+                    for line in compiler.report:
+                        result['output'].append('%s:%s' % (src, line))
                 #print "Execute code"
                 # Parsing done. Start the program execution
                 # (AST traversal)
-                ast.action(ENV)
+                env = compiler.execute(ast)
             except (QHDLLexError, QHDLSyntaxError,
                     QHDLTypeError, QHDLAttrError,
                     QHDLIndexError, QHDLNameError,
                     QHDLValueError), e:
-                print e
                 #print "Map generation aborted."
                 # Error executing the program. Skip to next
                 # source file specified
-                continue
+                result['errors'].append(str(e))
+                return result
 
             #print "Start maps generation"
-            
+
             # Start logging
             d = datetime.now()
             initLogger('%d%d%d-%s-build.log' % \
@@ -160,10 +571,27 @@ def main():
                             src[src.rfind(path.sep)+1:]))
             log('Start maps generation for source file [%s]' % \
                     src, 'info')
-            
-            for key, sym in ENV.globalScope.items():
+            if compiler.cacheHit:
+                log('Compiled source [%s] loaded from cache' % src,
+                    'info')
+            elif compiler.cacheHit is not None:
+                log('Compiled source [%s] not cached: source parsed' % \
+                        src, 'info')
+
+            # First generate the .map files, then compile them.
+            # The output of the stages whose input didn't change
+            # since a previous build is restored from the cache
+            exe = CompilerExe()
+            if bspCacheSize > 0:
+                cache = ArtifactCache('bsp', ARTIFACTS,
+                                      bspCacheSize*1024*1024)
+            else:
+                cache = None
+            maps = []
+            built = []
+            for key, sym in env.globalScope.items():
                 if sym.type == 'Map':
-                    m = Map(sym.value)
+                    m = Map(sym.value, resolveOverlaps, mergeBrushes)
                     if m.name == '':
                         m.name = 'Map%d' % i
                         log('Map with no defined name found. Set name as [%s]' % \
@@ -172,25 +600,182 @@ def main():
                     #print "Build map [%s]" % m.name
                     log('Map [%s] found. Start the building process' % \
                             m.name, 'info')
-                    if not Build(m):
+                    try:
+                        generated = exe is not None and Build(m)
+                    except Exception, e:
+                        # The other maps are built anyway
+                        log('Map [%s] generation fails: %s: %s' % \
+                                (m.name, e.__class__.__name__, e),
+                            'error')
+                        generated = False
+                    if not generated:
                         #print "Map [%s] building aborted." % \
                         #    m.name
                         log('Map [%s] building aborted.' % \
                             m.name, 'error')
+                        result['errors'].append('Map [%s] building aborted' % \
+                                                    m.name)
                         continue
 
-                    builtMaps += 1
-
-                    if installPath is not None:
-                        Install(m, installPath)
                     i += 1
+                    maps.append(m)
+
+            for res in CompileMaps(exe, stages, cache, patchEntities,
+                                   limits, maps, compileJobs):
+                m = res.map
+                if res.leaked:
+                    log('Map [%s] leaked' % m.name, 'warning')
+                if not res.success:
+                    # Map compilation fails!!!
+                    if res.error is not None:
+                        error = res.error
+                    elif res.timedOut:
+                        error = 'stage [%s] timed out' % res.stage
+                    else:
+                        error = 'stage [%s] exit code %d' % \
+                            (res.stage, res.returnCode)
+                    log('Map [%s] compilation fails!!! Error: %s\n%s' % \
+                            (m.name, error,
+                             '\n'.join(res.output[-ERROR_LINES:])),
+                        'error')
+                    log('Map [%s] building aborted.' % \
+                            m.name, 'error')
+                    result['errors'].append('Map [%s] building aborted (%s)' % \
+                                                (m.name, error))
+                    continue
+                log('Map [%s] compilation success!!!' % m.name, 'info')
+                built.append(m)
+
+            for m in built:
+                result['maps'].append(m.name)
+
+                if installPath is not None:
+                    Install(m, installPath)
 
+            if cache is not None:
+                log('Compiled maps cache: %d hits, %d misses, %d evictions' % \
+                        (cache.hits, cache.misses, cache.evictions),
+                    'info')
+
+            log("Done", 'info')
+        finally:
             # Come back to previous directory
             chdir(currDir)
-            log("Done", 'info')
 
-      except IOError:
-          pass
+    except (IOError, OSError), e:
+        result['errors'].append(str(e))
+
+    return result
+
+
+# Compiler of a worker process
+_COMPILER = None
+
+def _InitWorker():
+    global _COMPILER
+    _COMPILER = QHDLCompiler()
+
+
+# Build a source on a worker process, in its own work
+# subdirectory. The subdirectory only depends on the source
+# path, so that the files of the previous builds (as the
+# compiled maps geometry) are found again
+def _BuildSourceJob(args):
+    src, workDir, installPath, verbose, \
+        resolveOverlaps, compileJobs, bspCacheSize, stages, \
+        patchEntities, limits, mergeBrushes = args
+    name = path.splitext(path.basename(src))[0]
+    jobDir = path.join(workDir, '%s-%s' % \
+                           (name, HashContent(path.realpath(src))[:8]))
+    try:
+        return BuildSource(_COMPILER, src, jobDir, installPath,
+                           verbose, resolveOverlaps, compileJobs,
+                           bspCacheSize, stages, patchEntities, limits,
+                           mergeBrushes)
+    except Exception, e:
+        # Unexpected errors must not stop the other builds
+        return {'source':src, 'output':[], 'maps':[],
+                'errors':['%s: %s' % (e.__class__.__name__, e)]}
+
+
+# TO DO: how manage build errors?
+def main():
+    cmdLineArgs = ParseCmdLine()
+    sources = cmdLineArgs[1]
+    installPath = cmdLineArgs[0].installPath
+    workDir = cmdLineArgs[0].workDir
+    verbose = cmdLineArgs[0].verbose
+    jobs = cmdLineArgs[0].jobs
+    resolveOverlaps = cmdLineArgs[0].resolveOverlaps
+    mergeBrushes = cmdLineArgs[0].mergeBrushes
+    compileJobs = cmdLineArgs[0].compileJobs
+    bspCacheSize = cmdLineArgs[0].bspCacheSize
+    stages = cmdLineArgs[0].stages
+    patchEntities = cmdLineArgs[0].patchEntities
+    limits = {'timeout':cmdLineArgs[0].compileTimeout,
+              'memory':None,
+              'retries':cmdLineArgs[0].compileRetries}
+    if cmdLineArgs[0].compileMemory:
+        limits['memory'] = cmdLineArgs[0].compileMemory*1024*1024
+
+    # The sources built in parallel already use the CPUs
+    if compileJobs is None:
+        if jobs is None:
+            compileJobs = 0
+        else:
+            compileJobs = 1
+    compileJobs = compileJobs or cpu_count()
+
+    # If no working dir is specified, create a new one
+    if workDir is None:
+        workDir = path.join(path.curdir, 'tmp')
+    workDir = path.realpath(workDir)
+
+    if jobs is None:
+        # The same compiler is reused for all the sources: each
+        # one is executed on its own environment
+        compiler = QHDLCompiler()
+        results = (BuildSource(compiler, src, workDir,
+                               installPath, verbose,
+                               resolveOverlaps, compileJobs,
+                               bspCacheSize, stages, patchEntities,
+                               limits, mergeBrushes)
+                   for src in sources)
+    else:
+        # Each worker process has its own compiler. Results are
+        # collected as soon as each source is built
+        pool = Pool(jobs or cpu_count(), _InitWorker)
+        results = pool.imap_unordered(
+            _BuildSourceJob,
+            [(src, workDir, installPath, verbose,
+              resolveOverlaps, compileJobs, bspCacheSize,
+              stages, patchEntities, limits, mergeBrushes)
+             for src in sources])
+        pool.close()
+
+    builtMaps = 0
+    failedSources = 0
+    for result in results:
+        for line in result['output']:
+            print line
+        builtMaps += len(result['maps'])
+        if result['errors']:
+            failedSources += 1
+        if jobs is None:
+            for error in result['errors']:
+                print error
+        else:
+            if result['errors']:
+                print '[%s] failed: %s' % (result['source'],
+                                           '; '.join(result['errors']))
+            else:
+                print '[%s] built maps: %s' % \
+                    (result['source'], ', '.join(result['maps']))
+
+    if jobs is not None:
+        pool.join()
+        print '%d sources, %d failed, %d maps built' % \
+            (len(sources), failedSources, builtMaps)
 
     if builtMaps:
         return 0
@@ -1,9 +1,12 @@
 #from parser import ENV, parser
-from parser import ENV, BuildQHDLParser
+from parser import BuildQHDLParser
+from compiler import QHDLCompiler
+from cache import ArtifactCache, HashContent
+from bsp import ParseMap, MapGeometry, EntityLump, PatchEntityLump
 from lexer import QHDLLexError
 from parser import QHDLSyntaxError
 from parser_internals import \
     QHDLTypeError, QHDLAttrError, QHDLIndexError, \
     QHDLNameError, QHDLValueError
-from backend import Map, Horde, Monster, Player, Item, \
+from backend import Map, Horde, Monster, Item, EntityTable, \
     initLogger, log
@@ -5,6 +5,7 @@
 import logging
 from sys import stdout, stderr
 from math import sin, cos, pi
+from heapq import heappush, heappop
 from backend_internals import *
 
 # CONVERSION FACTOR
@@ -22,6 +23,11 @@ PLAYER_Y = 0
 
 # Validation logger
 def initLogger(logFileName):
+    # Each build logs on its own file
+    rootLogger = logging.getLogger()
+    for handler in rootLogger.handlers[:]:
+        rootLogger.removeHandler(handler)
+        handler.close()
     logging.basicConfig(filename=logFileName,
                         filemode='a',
                         level=logging.DEBUG,
@@ -51,25 +57,56 @@ class Map(object):
                  'cage_bar':('wood1', 1, 1),
                  'cage_exit':('metal1', 1, 1)}
 
-    def __init__(self, symbols):
+    # Footprint of the point entities, for the overlaps check
+    ENTITY_SIZE = (32, 32, 56)
+    # Rings of free places searched around an overlapping entity
+    NUDGE_RINGS = 8
+    # Overlaps detailed in the map warning
+    OVERLAPS_REPORTED = 5
+
+    # Cage bars spacing and size
+    BAR_STEP = 32
+    BAR_SIZE = (16, 16, 256)
+
+    CHUNK_BRUSHES = 1024
+    CHUNK_ENTITIES = 1024
+
+    # record is the QHDL Map record. If resolveOverlaps is set,
+    # the point entities overlapping other ones are moved to the
+    # nearest free place. If mergeBrushes is set, the world
+    # brushes are merged into larger boxes where possible
+    def __init__(self, record, resolveOverlaps=False,
+                 mergeBrushes=False):
         # Replace spaces with underscores in map names
-        self.name = symbols['name'].value.replace(' ', '_')
-        self.introMessage = symbols['introMessage'].value
-        self.width = MeterToQuake(symbols['width'].value)
-        self.height = MeterToQuake(symbols['height'].value)
-        self.type = symbols['type'].value
-        self.sNext = symbols['next'].value
-        self.sHordes = [sym.value
-                        for sym in symbols['hordes'].value]
-        self.sPlayers = symbols['players'].value
-        self.sItems = symbols['items'].value
-
+        self.name = record.name.replace(' ', '_')
+        self.introMessage = record.introMessage
+        self.width = MeterToQuake(record.width)
+        self.height = MeterToQuake(record.height)
+        self.type = record.type
+        self.sNext = record.next
+        self.sHordes = list(record.hordes)
+        self.sPlayers = record.players
+        self.sItems = record.items
+
+        # All the map brushes are stored in a single batch, and
+        # all the point entities in a single table
+        self.batch = BrushBatch()
+        self.entities = EntityTable()
         self.brushes = []
         self.players = []
         self.hordes = []
         self.items = []
         self.exitTrigger = None
         self.exit = []
+        # Bars of the cage (a slice of the batch)
+        self.bars = slice(0, 0)
+        self.barStep = Map.BAR_STEP
+        self.barSize = Map.BAR_SIZE
+        self.barMaterial = 'cage_bar'
+        self.resolveOverlaps = resolveOverlaps
+        self.mergeBrushes = mergeBrushes
+        # Number of brushes removed by the merge
+        self.mergedBrushes = 0
 
     
     # Internals methods for brushes building
@@ -81,14 +118,16 @@ class Map(object):
             Brush('floorA',
                   material=Map.MATERIALS['cage_ground'][0],
                   texX=Map.MATERIALS['cage_ground'][1],
-                  texY=Map.MATERIALS['cage_ground'][2])
+                  texY=Map.MATERIALS['cage_ground'][2],
+                  batch=self.batch)
         floorA.scale(self.width/2-exitSize, self.height, 1)
         
         floorB = \
             Brush('floorB',
                   material=Map.MATERIALS['cage_ground'][0],
                   texX=Map.MATERIALS['cage_ground'][1],
-                  texY=Map.MATERIALS['cage_ground'][2])
+                  texY=Map.MATERIALS['cage_ground'][2],
+                  batch=self.batch)
         floorB.scale(self.width/2-exitSize, self.height, 1)
         floorB.translate(self.width/2+exitSize, 0, 0)
 
@@ -96,7 +135,8 @@ class Map(object):
             Brush('floorC',
                   material=Map.MATERIALS['cage_ground'][0],
                   texX=Map.MATERIALS['cage_ground'][1],
-                  texY=Map.MATERIALS['cage_ground'][2])
+                  texY=Map.MATERIALS['cage_ground'][2],
+                  batch=self.batch)
         floorC.scale(exitSize*2, self.height/2-exitSize, 1)
         floorC.translate(self.width/2-exitSize, 0, 0)
         
@@ -104,57 +144,44 @@ class Map(object):
             Brush('floorD',
                   material=Map.MATERIALS['cage_ground'][0],
                   texX=Map.MATERIALS['cage_ground'][1],
-                  texY=Map.MATERIALS['cage_ground'][2])
+                  texY=Map.MATERIALS['cage_ground'][2],
+                  batch=self.batch)
         floorD.scale(exitSize*2, self.height/2-exitSize, 1)
         floorD.translate(self.width/2-exitSize,
                          self.height/2+exitSize, 0)
 
         self.cage.extend([floorA, floorB, floorC, floorD])
 
-        # Build walls bars
-        step = 32
-        barWidth = 16
-        barHeight = 16
-        barLenght = 256
-        n = 0
-        for i in range(max(self.width, self.height)/step):
-            if n <= self.width:
-                brush1a = \
-                    Brush('cage_0x_'+str(i),
-                          material=Map.MATERIALS['cage_bar'][0],
-                          texX=Map.MATERIALS['cage_bar'][1],
-                          texY=Map.MATERIALS['cage_bar'][2])
-                brush1a.scale(barWidth, barHeight, barLenght)
-                brush1a.translate(n, 0, 0)
-                brush1b = \
-                    Brush('cage_yx_'+str(i),
-                          material=Map.MATERIALS['cage_bar'][0],
-                          texX=Map.MATERIALS['cage_bar'][1],
-                          texY=Map.MATERIALS['cage_bar'][2])
-                brush1b.scale(barWidth, barHeight, barLenght)
-                brush1b.translate(n, self.height, 0)
-                self.cage.append(brush1a)
-                self.cage.append(brush1b)
-            if n <= self.height:
-                brush2a = \
-                    Brush('cage_0y_'+str(i),
-                          material=Map.MATERIALS['cage_bar'][0],
-                          texX=Map.MATERIALS['cage_bar'][1],
-                          texY=Map.MATERIALS['cage_bar'][2])
-                brush2a.scale(barWidth, barHeight, barLenght)
-                brush2a.translate(0, n, 0)
-                brush2b = Brush('cage_xy_'+str(i),
-                      material=Map.MATERIALS['cage_bar'][0],
-                      texX=Map.MATERIALS['cage_bar'][1],
-                      texY=Map.MATERIALS['cage_bar'][2])
-                brush2b.scale(barWidth, barHeight, barLenght)
-                brush2b.translate(self.width, n, 0)
-                self.cage.append(brush2a)
-                self.cage.append(brush2b)
-
-            n += step
-            if n > max(self.width, self.height)+step:
-                break
+        # Build walls bars: along each wall, a bar every
+        # barStep units. All the bars are copies of a single
+        # prototype, moved by their offsets
+        barWidth, barHeight, barLenght = self.barSize
+        n = arange(max(self.width, self.height)/self.barStep) * \
+            self.barStep
+        zero = zeros_like(n)
+        # For each step, the bars on the walls along x (at y=0
+        # and y=height), then on the walls along y
+        offsets = stack([stack([n, zero, zero], axis=-1),
+                         stack([n, zero+self.height, zero], axis=-1),
+                         stack([zero, n, zero], axis=-1),
+                         stack([zero+self.width, n, zero], axis=-1)],
+                        axis=1)
+        mask = stack([n <= self.width, n <= self.width,
+                      n <= self.height, n <= self.height], axis=1)
+        names = ('cage_0x_%d', 'cage_yx_%d',
+                 'cage_0y_%d', 'cage_xy_%d')
+        steps, walls = nonzero(mask)
+        ids = [names[wall] % i for i, wall in
+               zip(steps.tolist(), walls.tolist())]
+        material = Map.MATERIALS[self.barMaterial]
+        self.bars = self.batch.instance(ids,
+                                        BrushBatch.box(barWidth,
+                                                       barHeight,
+                                                       barLenght),
+                                        offsets[mask],
+                                        material=material[0],
+                                        texX=material[1],
+                                        texY=material[2])
 
         self.brushes.extend(self.cage)
             
@@ -165,7 +192,8 @@ class Map(object):
             Brush(self.name+'_main_brush',
                   material=Map.MATERIALS['walls_ground'][0],
                   texX=Map.MATERIALS['walls_ground'][1],
-                  texY=Map.MATERIALS['walls_ground'][2]))
+                  texY=Map.MATERIALS['walls_ground'][2],
+                  batch=self.batch))
         self.mainBrush = self.brushes[0]
         self.mainBrush.scale(self.width, self.height, 1.0)
 
@@ -174,31 +202,36 @@ class Map(object):
         wall1 = Brush('wall_1',
                       material=Map.MATERIALS['walls'][0],
                       texX=Map.MATERIALS['walls'][1],
-                      texY=Map.MATERIALS['walls'][2])
+                      texY=Map.MATERIALS['walls'][2],
+                      batch=self.batch)
         wall1.scale(self.width, 16, 256)
         wall2 = Brush('wall_2',
                       material=Map.MATERIALS['walls'][0],
                       texX=Map.MATERIALS['walls'][1],
-                      texY=Map.MATERIALS['walls'][2])
+                      texY=Map.MATERIALS['walls'][2],
+                      batch=self.batch)
         wall2.scale(self.width, 16, 256)
         wall2.translate(0, self.height, 0)
         wall3 = Brush('wall_3',
                       material=Map.MATERIALS['walls'][0],
                       texX=Map.MATERIALS['walls'][1],
-                      texY=Map.MATERIALS['walls'][2])
+                      texY=Map.MATERIALS['walls'][2],
+                      batch=self.batch)
         wall3.scale(16, self.height/2-exitSize, 256)
         wall3.translate(self.width, 0, 0)
         wall4 = Brush('wall_4',
                       material=Map.MATERIALS['walls'][0],
                       texX=Map.MATERIALS['walls'][1],
-                      texY=Map.MATERIALS['walls'][2])
+                      texY=Map.MATERIALS['walls'][2],
+                      batch=self.batch)
         wall4.scale(16, self.height/2-exitSize, 256)
         wall4.translate(self.width,
                         self.height/2+exitSize , 0)
         wall5 = Brush('wall_5',
                       material=Map.MATERIALS['walls'][0],
                       texX=Map.MATERIALS['walls'][1],
-                      texY=Map.MATERIALS['walls'][2])
+                      texY=Map.MATERIALS['walls'][2],
+                      batch=self.batch)
         wall5.scale(16, self.height, 256)
         self.brushes.extend([wall1, wall2, wall3,
                              wall4, wall5])
@@ -210,7 +243,8 @@ class Map(object):
         _exit = Door('exit_trigger',
                       material=Map.MATERIALS['walls_exit'][0],
                       texX=Map.MATERIALS['walls_exit'][1],
-                      texY=Map.MATERIALS['walls_exit'][2])
+                      texY=Map.MATERIALS['walls_exit'][2],
+                      batch=self.batch)
         _exit.scale(16, exitSize*2, 256)
         _exit.translate(self.width,
                         self.height/2-exitSize, 0)
@@ -219,11 +253,12 @@ class Map(object):
         # Build changelevel trigger
         if self.sNext is not None:
             nextMap = self.sNext
-            nextMapName = nextMap['name'].value
+            nextMapName = nextMap.name
         else:
             nextMapName = self.name
 
-        chLevelTrig = ChangeLevelTrigger(nextMapName)
+        chLevelTrig = ChangeLevelTrigger(nextMapName,
+                                         batch=self.batch)
         chLevelTrig.brush.scale(1, exitSize*4, 256)
         chLevelTrig.brush.translate(self.width+25,
                                     self.height/2-exitSize,
@@ -240,7 +275,8 @@ class Map(object):
             bar = Door('exit_trigger',
                       material=Map.MATERIALS['cage_exit'][0],
                       texX=Map.MATERIALS['cage_exit'][1],
-                      texY=Map.MATERIALS['cage_exit'][2])
+                      texY=Map.MATERIALS['cage_exit'][2],
+                      batch=self.batch)
             bar.scale(10, exitSize*2, 10)
             bar.translate(self.width/2-exitSize+offset,
                           self.height/2-exitSize,
@@ -251,11 +287,12 @@ class Map(object):
         # Build changelevel trigger
         if self.sNext is not None:
             nextMap = self.sNext
-            nextMapName = nextMap['name'].value
+            nextMapName = nextMap.name
         else:
             nextMapName = self.name
 
-        chLevelTrig = ChangeLevelTrigger(nextMapName)
+        chLevelTrig = ChangeLevelTrigger(nextMapName,
+                                         batch=self.batch)
         chLevelTrig.brush.scale(exitSize*4, exitSize*4, 1)
         chLevelTrig.brush.translate(self.width/2-exitSize,
                                     self.height/2-exitSize,
@@ -276,95 +313,102 @@ class Map(object):
         # Build players start point. If no player start
         # point is specified, define a default one
         if len(self.sPlayers) == 0:
-            self.players.append(Player('%s_singleplayer' % \
-                                           self.name,
-                                       self.width/2,
-                                       self.height/2, 25))
+            self.players.append(self.entities.addPlayer(
+                    '%s_singleplayer' % self.name,
+                    self.width/2, self.height/2, 25))
 
         else:
             playerName = self.name + '_singleplayer'
-            playerX = MeterToQuake(\
-                self.sPlayers[0].value['x'].value)
-            playerY = MeterToQuake(\
-                self.sPlayers[0].value['y'].value)
-            self.players.append(Player(playerName,
-                                       playerX,
-                                       playerY,
-                                       25))
-            for playerSym in self.sPlayers[1:]:
+            playerX = MeterToQuake(self.sPlayers[0].x)
+            playerY = MeterToQuake(self.sPlayers[0].y)
+            self.players.append(
+                self.entities.addPlayer(playerName,
+                                        playerX,
+                                        playerY,
+                                        25))
+            for playerRec in self.sPlayers[1:]:
                 playerName = self.name + '_playercoop'
-                playerX = MeterToQuake(\
-                    playerSym.value['x'].value)
-                playerY = MeterToQuake(\
-                    playerSym.value['y'].value)
-                self.players.append(Player(playerName,
-                                           playerX,
-                                           playerY,
-                                           25, isCoop=True))
-
-        y = 0
-        validHordes = 0
-        for hordeSym in self.sHordes:
+                playerX = MeterToQuake(playerRec.x)
+                playerY = MeterToQuake(playerRec.y)
+                self.players.append(
+                    self.entities.addPlayer(playerName,
+                                            playerX,
+                                            playerY,
+                                            25, isCoop=True))
+
+        hordesGraph = self._sortHordes()
+        if hordesGraph is None:
+            return False
+        order, firedBy = hordesGraph
+
+        # Hordes are built in firing order, so that the monsters
+        # of the hordes firing a horde are known when it's built
+        built = {}
+        for i in order:
+            hordeSym = self.sHordes[i]
             # Used for compute the initial position
             # of the horde (which is the horde position
             # first than the horde is teleported into
             # the map)
             x = 0
-            y += 200
+            y = 200*(i+1)
             z = -800
 
-            if hordeSym is self.sHordes[-1]:
-                # The last horde activates the exit doors
-                lastHorde = True
-            else:
-                lastHorde = False
+            # The last horde activates the exit doors
+            lastHorde = i == order[-1]
 
-            i = self.sHordes.index(hordeSym)
-            # If no id is specified for current horde,
-            # define a new one
-            if hordeSym['id'].value == '':
-            #    hordeId = "%s_horde%d" % (self.name, i)
-                log('%d-th horde of map [%s] has no unique id' % \
-                        (i+1, self.name), 'error')
-                return False
-            else:
-                hordeId = hordeSym['id'].value
-
-            if i>0 and self.sHordes[i-1]['next'].value \
-                    is not None:
-                # The horde is not the first horde and
-                # it's activated by the previous horde
-                nMonst = \
-                    len(self.hordes[i-1].monsters)
-                horde = Horde(hordeId, hordeSym, self.name,
+            firing = [built[j] for j in firedBy[i] if j in built]
+            if firing:
+                # The horde is activated when all the monsters
+                # of the hordes firing it are dead
+                nMonst = sum([len(horde.monsters)
+                              for horde in firing])
+                horde = Horde(hordeSym.id, hordeSym, self.name,
                               x, y, z,
                               isFired=True,
                               fireCount=nMonst,
-                              fireExit=lastHorde)
+                              fireExit=lastHorde,
+                              batch=self.batch,
+                              entities=self.entities)
             else:
+                if firedBy[i]:
+                    log("Hordes firing horde [%s] are not valid: it's activated by a trigger" % \
+                            hordeSym.id, 'warning')
                 # The horde is activated by a player-touched
                 # trigger
-                horde = Horde(hordeId, hordeSym, self.name, 
+                horde = Horde(hordeSym.id, hordeSym, self.name, 
                               x, y, z,
-                              fireExit=lastHorde)
+                              fireExit=lastHorde,
+                              batch=self.batch,
+                              entities=self.entities)
             
             if horde.setup(self.width, self.height):
                 self.hordes.append(horde)
+                built[i] = horde
 
         if len(self.hordes) == 0:
             log("No valid hordes specified for map [%s]" % \
                     self.name, 'warning')
             return False
 
+        # The exit opens when the monsters of the last horde are
+        # dead: only its monsters fire the exit
+        exitHorde = built.get(order[-1])
+        if exitHorde is None:
+            log("Last horde [%s] of map [%s] is not valid: the exit can't be opened" % \
+                    (self.sHordes[order[-1]].id, self.name), 'error')
+            return False
+
         # Add items
         i=0
         for item in self.sItems:
             it = Item('%s_%s%d' % \
                           (self.name,
-                           item.value['type'].value, i),
-                      item.value)
+                           item.type, i),
+                      item, entities=self.entities)
             if it.setup(self.width, self.height):
                 self.items.append(it)
+            i += 1
 
         # Finally, create the map brushes and the exit-door
         if self.type == 'cage':
@@ -379,76 +423,273 @@ class Map(object):
                     self.width/2,
                     self.height/2,
                     isCounter=True,
-                    count=len(self.hordes[-1].monsters))
+                    count=len(exitHorde.monsters),
+                    batch=self.batch)
+
+        self._checkOverlaps()
+        if self.mergeBrushes:
+            self._mergeBrushes()
         return True
+
+
+    # Merge the world brushes (but the hordes support brushes,
+    # which are written on their own)
+    def _mergeBrushes(self):
+        rows = [brush.index for brush in self.brushes] + \
+            range(*self.bars.indices(len(self.batch)))
+        merged = self.batch.mergeBoxes(rows)
+        self.brushes = [Brush(self.batch.ids[i], batch=self.batch,
+                              index=i)
+                        for i in merged]
+        self.bars = slice(0, 0)
+        self.mergedBrushes = len(rows) - len(merged)
+        log('%d of %d world brushes of map [%s] removed by merging' % \
+                (self.mergedBrushes, len(rows), self.name), 'info')
+
+
+    # Index the hordes by id and resolve their next links. Return
+    # the indices of the hordes in firing order (each horde after
+    # the hordes firing it, otherwise in the map order) and, for
+    # each horde, the indices of the hordes firing it. Return None
+    # if the hordes ids aren't unique or the hordes fire each other
+    # in a cycle
+    def _sortHordes(self):
+        index = {}
+        for i, hordeSym in enumerate(self.sHordes):
+            if hordeSym.id == '':
+                log('%d-th horde of map [%s] has no unique id' % \
+                        (i+1, self.name), 'error')
+                return None
+            if hordeSym.id in index:
+                log('Horde id [%s] used twice on map [%s]' % \
+                        (hordeSym.id, self.name), 'error')
+                return None
+            index[hordeSym.id] = i
+
+        firedBy = [[] for hordeSym in self.sHordes]
+        for i, hordeSym in enumerate(self.sHordes):
+            if hordeSym.next is None:
+                continue
+            j = index.get(hordeSym.next.id)
+            if j is None:
+                log('Horde [%s] fires horde [%s], which is not on map [%s]' % \
+                        (hordeSym.id, hordeSym.next.id, self.name),
+                    'warning')
+                continue
+            firedBy[j].append(i)
+
+        # Topological sort: the ready hordes are taken in the map
+        # order
+        pending = [len(hordes) for hordes in firedBy]
+        ready = [i for i in range(len(pending)) if pending[i] == 0]
+        order = []
+        while ready:
+            i = heappop(ready)
+            order.append(i)
+            hordeSym = self.sHordes[i]
+            if hordeSym.next is not None:
+                j = index.get(hordeSym.next.id)
+                if j is not None:
+                    pending[j] -= 1
+                    if pending[j] == 0:
+                        heappush(ready, j)
+
+        if len(order) < len(self.sHordes):
+            log('Hordes [%s] of map [%s] are never activated: their next links form a cycle' % \
+                    (', '.join([self.sHordes[i].id
+                                for i in range(len(pending))
+                                if pending[i] > 0]),
+                     self.name), 'error')
+            return None
+        return order, firedBy
+
+
+    # Box of a point entity footprint
+    def _entityBox(self, x, y, z):
+        sizeX, sizeY, sizeZ = Map.ENTITY_SIZE
+        return (x-sizeX/2, y-sizeY/2, z), (x+sizeX/2, y+sizeY/2, z+sizeZ)
+
+
+    # Look for point entities (flames apart, which are not solid)
+    # and horde triggers overlapping each other, using a grid
+    # index of the already checked ones. Overlapping entities
+    # are moved if resolveOverlaps is set. Overlaps are reported
+    # once for the whole map
+    def _checkOverlaps(self):
+        table = self.entities
+        grid = SpatialGrid()
+        origins = table.origins[:len(table)].tolist()
+        overlaps = []
+        moved = 0
+        # Places with no free place around them: the grid only
+        # grows, so they are not searched again
+        crowded = set()
+        for row in range(len(table)):
+            # Monsters wait stacked out of the map until they are
+            # teleported to their destination
+            if table.kinds[row] in (EntityTable.FLAME,
+                                    EntityTable.MONSTER):
+                continue
+            mins, maxs = self._entityBox(*origins[row])
+            # Only the first overlapped entity is reported: many
+            # entities may share the same place
+            others = grid.overlaps(mins, maxs, 1)
+            if others:
+                names = table.ids[others[0]]
+                overlaps.append('[%s] overlaps [%s]' % \
+                                    (table.ids[row], names))
+                if self.resolveOverlaps:
+                    box = self._nudge(row, grid, names, crowded)
+                    if box is not None:
+                        mins, maxs = box
+                        moved += 1
+            grid.insert(row, mins, maxs)
+
+        # Triggers touched by the player
+        grid = SpatialGrid()
+        for i, horde in enumerate(self.hordes):
+            if horde.isFired:
+                continue
+            mins, maxs = self.batch.bounds(horde.hordeTrigger.brush.index)
+            others = grid.overlaps(mins, maxs, 1)
+            if others:
+                overlaps.append('trigger of [%s] overlaps the trigger of [%s]' % \
+                                    (horde.id, self.hordes[others[0]].id))
+            grid.insert(i, mins, maxs)
+
+        if not overlaps:
+            return
+        for overlap in overlaps:
+            log('Map [%s]: %s' % (self.name, overlap), 'debug')
+        report = '; '.join(overlaps[:Map.OVERLAPS_REPORTED])
+        if len(overlaps) > Map.OVERLAPS_REPORTED:
+            report += '; ...'
+        if self.resolveOverlaps:
+            report = '%d moved; %s' % (moved, report)
+        log('%d overlaps found on map [%s] (%s)' % \
+                (len(overlaps), self.name, report), 'warning')
+
+
+    # Move an overlapping entity to the nearest free place inside
+    # the map. Places are searched on rings of entity-sized
+    # steps around the entity. Return the new entity box, None if
+    # no free place was found (the entity place is then added to
+    # crowded)
+    def _nudge(self, row, grid, names, crowded):
+        table = self.entities
+        x, y, z = table.origins[row].tolist()
+        if (x, y, z) in crowded:
+            log('Entity [%s] overlaps [%s] on map [%s]: no free place found' % \
+                    (table.ids[row], names, self.name), 'debug')
+            return None
+        stepX, stepY = Map.ENTITY_SIZE[:2]
+        for ring in range(1, Map.NUDGE_RINGS+1):
+            places = [(i, j) for i in range(-ring, ring+1)
+                      for j in range(-ring, ring+1)
+                      if max(abs(i), abs(j)) == ring]
+            places.sort(key=lambda p: p[0]*p[0] + p[1]*p[1])
+            for i, j in places:
+                dx, dy = i*stepX, j*stepY
+                if not (32 <= x+dx <= self.width-32 and
+                        32 <= y+dy <= self.height-32):
+                    continue
+                mins, maxs = self._entityBox(x+dx, y+dy, z)
+                if not grid.overlaps(mins, maxs, 1):
+                    table.translate(row, dx, dy, 0)
+                    log('Entity [%s] overlapping [%s] moved by (%d, %d) on map [%s]' % \
+                            (table.ids[row], names, dx, dy,
+                             self.name), 'debug')
+                    return mins, maxs
+        log('Entity [%s] overlaps [%s] on map [%s]: no free place found' % \
+                (table.ids[row], names, self.name), 'debug')
+        crowded.add((x, y, z))
+        return None
         
     
-    def __str__(self):
+    # Generate the .map code piece by piece, so that maps of any
+    # size can be written with constant memory. Brushes are
+    # formatted in blocks of CHUNK_BRUSHES
+    def iterChunks(self):
         # TODO: print some statistics here
         #       (date, author, etc.)
-        retVal = '// Map %s\n{\n' % self.name
-        retVal += '"classname" "worldspawn"\n'
-
-        # Generate main brushes
-        retVal += ''.join([str(brush)+'\n'
-                           for brush in self.brushes])+'\n'
-        
+        yield '// Map %s\n{\n' % self.name
+        yield '"classname" "worldspawn"\n'
+
+        # Generate main brushes. All the brushes are in the map
+        # batch
+        rows = [brush.index for brush in self.brushes] + \
+            range(*self.bars.indices(len(self.batch)))
+        for i in range(0, len(rows), Map.CHUNK_BRUSHES):
+            yield self.batch.formatBrushes(
+                rows[i:i+Map.CHUNK_BRUSHES], suffix='\n')
+        yield '\n'
 
         # Generate all hordes support brushes
-        retVal += \
-            ''.join(['\n// %s support brush\n%s' % 
-                     (horde.id, str(horde.supBrush))
-                     for horde in self.hordes])
-        retVal += '\n}\n'
-
-        # Generate exit doors
-        retVal += \
-            ''.join([str(door)+'\n'
-                     for door in self.exit])
-
-        # Generate exit trigger
-        retVal += str(self.exitTrigger) + '\n'
+        for i in range(0, len(self.hordes), Map.CHUNK_BRUSHES):
+            hordes = self.hordes[i:i+Map.CHUNK_BRUSHES]
+            yield self.batch.formatBrushes(
+                [horde.supBrush.index for horde in hordes],
+                prefixes=['\n// %s support brush\n' % horde.id
+                          for horde in hordes])
+        yield '\n}\n'
+
+        # Generate exit doors and exit trigger
+        yield self.batch.formatEntities(self.exit + [self.exitTrigger],
+                                        suffix='\n')
 
         # Generate hordes
-        retVal += \
-            ''.join([str(horde) for horde in self.hordes])
-        retVal += '\n'
+        for horde in self.hordes:
+            yield str(horde)
+        yield '\n'
 
         # Generate player start points
-        retVal += ''.join([str(player)
-                           for player in self.players])
-        retVal += '\n'
+        yield self.entities.formatEntities(self.players)
+        yield '\n'
         
         # Generate items
-        retVal += ''.join(str(item)
-                          for item in self.items)
+        for i in range(0, len(self.items), Map.CHUNK_ENTITIES):
+            yield self.entities.formatEntities(
+                [item.item for item in
+                 self.items[i:i+Map.CHUNK_ENTITIES]])
 
-        return retVal
+
+    # Write the .map code to a (file-like) stream
+    def write(self, stream):
+        for chunk in self.iterChunks():
+            stream.write(chunk)
+
+
+    def __str__(self):
+        return ''.join(self.iterChunks())
 
 
 
 class Horde(object):
 
-    def __init__(self, _id, symbols, mapName, x, y, z,
+    def __init__(self, _id, record, mapName, x, y, z,
                  isFired=False, fireCount=0,
-                 fireExit=False):
+                 fireExit=False, batch=None, entities=None):
         self.id = _id
-        self.x = MeterToQuake(symbols['x'].value)
-        self.y = MeterToQuake(symbols['y'].value)
-        self.fireX = MeterToQuake(symbols['fireX'].value)
-        self.fireY = MeterToQuake(symbols['fireY'].value)
-        self.message = symbols['message'].value
+        self.x = MeterToQuake(record.x)
+        self.y = MeterToQuake(record.y)
+        self.fireX = MeterToQuake(record.fireX)
+        self.fireY = MeterToQuake(record.fireY)
+        self.message = record.message
         self.realX = x
         self.realY = y
         self.realZ= z
-        self.sNext = symbols['next'].value
-        self.delay = symbols['delay'].value
-        self.sMonsters = \
-            [sym.value
-             for sym in symbols['monsters'].value]
+        self.sNext = record.next
+        self.delay = record.delay
+        self.sMonsters = list(record.monsters)
         self.isFired = isFired
         self.fireCount = fireCount
         self.fireExit = fireExit
+        if batch is None:
+            batch = BrushBatch()
+        self.batch = batch
+        if entities is None:
+            entities = EntityTable()
+        self.entities = entities
 
         self.nMonsters = len(self.sMonsters)
         self.monsters = []
@@ -471,12 +712,45 @@ class Horde(object):
         for i in range(0,12):
             flameX = x + radius*cos(angle)
             flameY = y + radius*sin(angle)
-            self.flames.append(Flame("%s_flame%d" % \
-                                         (self.id, i),
-                                     _type, 2, flameX, flameY, 0))
+            self.flames.append(
+                self.entities.addFlame("%s_flame%d" % (self.id, i),
+                                       _type, 2, flameX, flameY, 0))
             angle += angleStep
 
 
+    # Offsets of the first count positions of the monsters
+    # spiral. At each position the angle grows by angleStep; after
+    # a full turn the angle restarts from 0, the radius grows and
+    # the step shrinks. Angles are accumulated in the same order
+    # of a position-by-position computation, so the offsets are
+    # exactly the same
+    @staticmethod
+    def _spiral(count):
+        xs = []
+        ys = []
+        angleStep = 1.0
+        step = 180
+        while count > 0:
+            if angleStep > 0:
+                size = min(count, int(2*pi/angleStep)+2)
+            else:
+                size = count
+            angles = concatenate(([0.0],
+                                  cumsum(repeat(angleStep, size))))
+            # Positions of this turn
+            n = min(count, int(argmax(append(angles >= 2*pi,
+                                             True))))
+            xs.append(step * cos(angles[:n]))
+            ys.append(step * sin(angles[:n]))
+            count -= n
+            step += 80
+            if angleStep != 0:
+                angleStep -= 0.2
+        if not xs:
+            return zeros(0), zeros(0)
+        return concatenate(xs), concatenate(ys)
+
+
     def setup(self, boundX, boundY):
         # Check if specified position is inside the map area
         if self.x > boundX or \
@@ -494,7 +768,7 @@ class Horde(object):
                 self.id
 
         # Create the supporting surface
-        supBrush = Brush(self.id + '_brush')
+        supBrush = Brush(self.id + '_brush', batch=self.batch)
         # Each monster has a 100x100 support area
         supBrush.scale(self.nMonsters*100, 100, 1)
         supBrush.translate(self.realX,
@@ -510,13 +784,15 @@ class Horde(object):
                                    delay=self.delay,
                                    message=self.message,
                                    isCounter=True,
-                                   count=self.fireCount)
+                                   count=self.fireCount,
+                                   batch=self.batch)
         else:
             # Horde triggered when the player walk upon
             # a specific map position
             hordeTrigger = Trigger(self.id,
                                    delay=self.delay,
-                                   message=self.message)
+                                   message=self.message,
+                                   batch=self.batch)
             hordeTrigger.brush.scale(20, 20, 1)
             hordeTrigger.translate(self.fireX,
                                    self.fireY, 1)
@@ -524,53 +800,84 @@ class Horde(object):
         self.hordeTrigger = hordeTrigger
 
         # Create monsters and their destinations
-        angle = 0.0
-        angleStep = 1.0
-        xStep = 180
-        yStep = 180
-        i = 0
-
         nextHordeName = ''
         if self.fireExit:
             nextHordeName = 'exit'
         elif self.sNext is not None:
-            nextHordeName = self.sNext['id'].value
-        
-        for monstSym in self.sMonsters:
-            # Compute monsters' teleport destination
-            x = xStep * cos(angle)
-            y = yStep * sin(angle)
-            i += 1
-
+            nextHordeName = self.sNext.id
+
+        # Monsters with a valid type are placed, in order, along
+        # a spiral around the horde position. A monster placed
+        # outside the map is rejected, and the next one takes
+        # its place: so all the monsters following the first
+        # one outside the map are rejected too
+        validType = array([(monstSym.type or Monster.DEFAULTS['type'])
+                           in Monster.VALID['type']
+                           for monstSym in self.sMonsters],
+                          dtype=bool)
+        slots = cumsum(validType) - 1
+        nSlots = int(validType.sum())
+        xs, ys = Horde._spiral(nSlots)
+        xs += self.x
+        ys += self.y
+        outside = flatnonzero(~Monster.isInside(xs, ys,
+                                                boundX, boundY))
+        if len(outside) > 0:
+            nPlaced = int(outside[0])
+        else:
+            nPlaced = nSlots
+        placed = validType & (slots < nPlaced)
+        slots = minimum(maximum(slots, 0), nPlaced).tolist()
+        xs = xs.tolist()
+        ys = ys.tolist()
+        realX = self.realX
+
+        for i, monstSym in enumerate(self.sMonsters):
             # Get the monster id: if no id is specified,
             # define a unique id for the monster
-            if monstSym['id'].value == '':
-                monstId = '%s_monst%d' % (self.id, i)
+            if monstSym.id == '':
+                monstId = '%s_monst%d' % (self.id, i+1)
             else:
-                monstId = '%s%d' % (monstSym['id'].value, i)
+                monstId = '%s%d' % (monstSym.id, i+1)
+            k = slots[i]
+            if k < nSlots:
+                x, y = xs[k], ys[k]
+            else:
+                # The monster is rejected for its type
+                x, y = self.x, self.y
             monster = Monster(monstId, monstSym, self.id,
-                              self.x+x, self.y+y, 20,
-                              self.realX,
+                              x, y, 20,
+                              realX + 100*k,
                               self.realY,
                               self.realZ,
-                              nextHordeName)
+                              nextHordeName,
+                              batch=self.batch,
+                              entities=self.entities)
 
-            # Setup the monster and add it to current horde
-            if not monster.setup(boundX, boundY):
+            if not placed[i]:
+                # Warn the user about the rejected monster
+                monster.setup(boundX, boundY)
                 continue
+            monster.validate()
             self.monsters.append(monster)
 
-            # Update data for next monster placement
-            angle += angleStep
-            self.realX += 100
-            if angle >= 2*pi:
-                angle = 0
-                #xStep += xStep
-                #yStep += yStep
-                xStep += 80
-                yStep += 80
-                if angleStep != 0:
-                    angleStep -= 0.2
+        # Build the teleports and triggers brushes of all the
+        # monsters at once
+        realXs = realX + 100*arange(nPlaced)
+        teleports = self.batch.extend([monster.id + '_teleport_brush'
+                                       for monster in self.monsters])
+        self.batch.scale(teleports, 80, 80, 1)
+        self.batch.translate(teleports, realXs+10,
+                             self.realY+10, self.realZ)
+        triggers = self.batch.extend([monster.id + '_trigger_brush'
+                                      for monster in self.monsters])
+        self.batch.translate(triggers, realXs+10,
+                             self.realY+10, self.realZ+100)
+        for monster, teleport, trigger in \
+                zip(self.monsters, self.batch.brushes(teleports),
+                    self.batch.brushes(triggers)):
+            monster.build(teleport, trigger)
+        self.realX = realX + 100*nPlaced
 
         if len(self.monsters) > 0:
             if not self.isFired:
@@ -584,16 +891,25 @@ class Horde(object):
 
 
     def __str__(self):
+        # The brushes of the horde trigger and of the monsters
+        # teleports and triggers are formatted at once
+        n = len(self.monsters)
+        codes = self.batch.brushStrs(
+            [self.hordeTrigger.brush.index] +
+            [monster.teleport.brush.index for monster in self.monsters] +
+            [monster.trigger.brush.index for monster in self.monsters])
+
         # Horde trigger
-        retVal = str(self.hordeTrigger)
-        
+        retVal = self.hordeTrigger.format(codes[0])
+
         # Generate monsters
         retVal += '\n%s\n' % ''.join(
-            [str(monster) for monster in self.monsters])
+            [monster.format(teleportCode, triggerCode)
+             for monster, teleportCode, triggerCode in
+             zip(self.monsters, codes[1:n+1], codes[n+1:])])
 
         # Generate flames
-        retVal += ''.join([str(flame)
-                           for flame in self.flames])
+        retVal += self.entities.formatEntities(self.flames)
 
         return retVal
 
@@ -606,10 +922,11 @@ class Monster(object):
                      'tarbaby', 'wizard', 'zombie']}
     DEFAULTS = {'type':'army'}
 
-    def __init__(self, _id, symbols, hordeName, x, y, z, 
-                 realX, realY, realZ, nextHordeName=None):
+    def __init__(self, _id, record, hordeName, x, y, z, 
+                 realX, realY, realZ, nextHordeName=None,
+                 batch=None, entities=None):
         self.id = _id
-        self.type = symbols['type'].value
+        self.type = record.type
         self.hordeName = hordeName
         self.x = x
         self.y = y
@@ -618,6 +935,10 @@ class Monster(object):
         self.realY = realY
         self.realZ = realZ
         self.nextHordeName = nextHordeName
+        self.batch = batch
+        if entities is None:
+            entities = EntityTable()
+        self.entities = entities
         
         self.trigger = None
         self.teleport = None
@@ -641,78 +962,87 @@ class Monster(object):
         return True
 
 
+    # Monsters must be 32 units away from the map bounds. It
+    # works on arrays of positions too
+    @staticmethod
+    def isInside(x, y, boundX, boundY):
+        return (x <= boundX-32) & (y <= boundY-32) & \
+            (x >= 32) & (y >= 32)
+
+
     def setup(self, boundX, boundY):
-        # Check monster type
-        if self.type == '':
-            # Not specified: init defaults
-            self.type = Monster.DEFAULTS['type']
-        elif self.type not in Monster.VALID['type']:
-            # Wrong tyep specified: warn the user and
-            # return false
-            log("Invalid type [%s] of monster [%s] on horde [%s]" % \
-                    (self.type,
-                     self.id,
-                     self.hordeName), 'warning')
+        if not self.validate():
             return False
 
         # Check the monster position
-        if self.x > (boundX-32) or \
-                self.y > (boundY-32) or \
-                self.x < 32 or \
-                self.y < 32:
+        if not Monster.isInside(self.x, self.y, boundX, boundY):
             log("Invalid position specified for monster [%s] of horde [%s]" % \
                     (self.id,
                      self.hordeName), 'warning')
             return False
 
+        self.build()
+        return True
+
+
+    # Create the monster entities. The brushes of the teleport
+    # and of the trigger may be given already in place, as a
+    # horde builds the brushes of all its monsters at once
+    def build(self, teleportBrush=None, triggerBrush=None):
         # Create the monster
-        monster = \
-            MonsterEntity(self.id, self.type,
-                          self.realX+50,
-                          self.realY+50,
-                          self.realZ+25,
-                          self.nextHordeName+'_fire')
-        self.monstEntity = monster
+        self.monstEntity = \
+            self.entities.addMonster(self.id, self.type,
+                                     self.realX+50,
+                                     self.realY+50,
+                                     self.realZ+25,
+                                     self.nextHordeName+'_fire')
         # Create monster teleport
-        teleport = MonsterTeleport(self.id)
-        teleport.brush = Brush(teleport.id + \
-                                   '_teleport_brush')
-        teleport.brush.scale(80, 80, 1)
-        teleport.translate(self.realX+10,
-                           self.realY+10,
-                           self.realZ)
-        self.teleport = teleport
+        if teleportBrush is None:
+            teleportBrush = Brush(self.id + '_teleport_brush',
+                                  batch=self.batch)
+            teleportBrush.scale(80, 80, 1)
+            teleportBrush.translate(self.realX+10,
+                                    self.realY+10,
+                                    self.realZ)
+        self.teleport = MonsterTeleport(self.id,
+                                        brush=teleportBrush)
 
         # Create the trigger
-        trigger = MonsterTrigger(self.id,
-                                 self.hordeName)
-        trigger.brush = Brush(trigger.id + \
-                                  '_trigger_brush')
-        trigger.brush.translate(self.realX+10,
-                                self.realY+10,
-                                self.realZ + 100)
-        self.trigger = trigger
+        if triggerBrush is None:
+            triggerBrush = Brush(self.id + '_trigger_brush',
+                                 batch=self.batch)
+            triggerBrush.translate(self.realX+10,
+                                   self.realY+10,
+                                   self.realZ + 100)
+        self.trigger = MonsterTrigger(self.id,
+                                      self.hordeName,
+                                      brush=triggerBrush)
 
         # Create the destination
-        destination = MonsterDestination(self.id,
+        self.destination = \
+            self.entities.addDestination(self.id,
                                          self.x,
                                          self.y,
                                          self.z)
-        self.destination = destination
-        
-        return True
 
 
-    def __str__(self):
+    # Fill the monster entities with the code of the teleport
+    # and trigger brushes
+    def format(self, teleportCode, triggerCode):
         retVal = '\n// Monster %s\n' % self.id
-        retVal += str(self.teleport)
-        retVal += str(self.monstEntity)
-        retVal += str(self.trigger)
-        retVal += str(self.destination)
+        retVal += self.teleport.format(teleportCode)
+        retVal += self.entities.entityStr(self.monstEntity)
+        retVal += self.trigger.format(triggerCode)
+        retVal += self.entities.entityStr(self.destination)
         
         return retVal
 
 
+    def __str__(self):
+        return self.format(str(self.teleport.brush),
+                           str(self.trigger.brush))
+
+
 class Item(object):
 
     VALID = {'type':{'health':[],
@@ -731,13 +1061,16 @@ class Item(object):
              'size':['small', 'medium', 'big']}
     DEFAULTS = {'type':'health', 'size':'medium'}
 
-    def __init__(self, _id, symbols):
+    def __init__(self, _id, record, entities=None):
         self.id = _id
-        self.type = symbols['type'].value
-        self.subType = symbols['subType'].value
-        self.size = symbols['size'].value
-        self.x = MeterToQuake(symbols['x'].value)
-        self.y = MeterToQuake(symbols['y'].value)
+        self.type = record.type
+        self.subType = record.subType
+        self.size = record.size
+        self.x = MeterToQuake(record.x)
+        self.y = MeterToQuake(record.y)
+        if entities is None:
+            entities = EntityTable()
+        self.entities = entities
         self.item = None
         
 
@@ -754,8 +1087,8 @@ class Item(object):
         if self.type == '':
             self.type = 'health'
             self.size = 'medium'
-            self.item = Health(self.id, self.size,
-                               self.x, self.y, 25)
+            self.item = self.entities.addHealth(self.id, self.size,
+                                                self.x, self.y, 25)
             return True
 
         # Setup health item
@@ -764,8 +1097,8 @@ class Item(object):
                 log("Invalid size [%s] for health [%s]" % \
                         (self.id, self.size), 'warning')
                 return False
-            self.item = Health(self.id, self.size,
-                               self.x, self.y, 25)
+            self.item = self.entities.addHealth(self.id, self.size,
+                                                self.x, self.y, 25)
 
         # Setup armor item
         elif self.type == 'armor':
@@ -773,8 +1106,8 @@ class Item(object):
                 log("Invalid size [%s] for ammo [%s]" % \
                         (self.size, self.id), 'warning')
                 return False
-            self.item = Armor(self.id, self.size,
-                              self.x, self.y, 25)
+            self.item = self.entities.addArmor(self.id, self.size,
+                                               self.x, self.y, 25)
         
         # Setup artifact item
         elif self.type == 'artifact':
@@ -783,8 +1116,8 @@ class Item(object):
                 log("Invalid sub-type [%s] for artifact [%s]" % \
                         (self.subType, self.id), 'warning')
                 return False
-            self.item = Artifact(self.id, self.subType,
-                                 self.x, self.y, 25)
+            self.item = self.entities.addArtifact(self.id, self.subType,
+                                                  self.x, self.y, 25)
 
         # Setup ammo item
         elif self.type == 'ammo':
@@ -803,8 +1136,9 @@ class Item(object):
                 log("Invalid sub-type [%s] for ammo [%s]" %  \
                         (self.subType, self.id), 'warning')
                 return False
-            self.item = Ammo(self.id, self.subType,         
-                             self.size, self.x, self.y, 25)
+            self.item = self.entities.addAmmo(self.id, self.subType,
+                                              self.size,
+                                              self.x, self.y, 25)
 
         # Setup weapon item
         elif self.type == 'weapon':
@@ -813,8 +1147,8 @@ class Item(object):
                 log("Invalid sub-type [%s] for weapon [%s]" % \
                         (self.subType, self.id), 'warning')
                 return False
-            self.item = Weapon(self.id, self.subType,
-                               self.x, self.y, 25)
+            self.item = self.entities.addWeapon(self.id, self.subType,
+                                                self.x, self.y, 25)
         
         else:
             log("Invalid type [%s] for item [%s]" % \
@@ -826,4 +1160,4 @@ class Item(object):
 
 
     def __str__(self):
-        return str(self.item)
+        return self.entities.entityStr(self.item)
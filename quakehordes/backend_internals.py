@@ -3,69 +3,333 @@
 #
 #*************************************************
 from math import sqrt
+from itertools import chain
 from numpy import *
 
+# Store of the brushes of a map. Every brush is a row of a
+# (N, 6, 3, 4) array, holding three points (in homogeneous
+# coordinates) for each of its six planes. Materials and textures
+# scales are stored as columns. Transformations apply to whole
+# selections of rows (an index, a slice or an array of indices):
+# they are composed into a 4x4 matrix for each brush, and applied
+# to the points of all the transformed brushes at once when the
+# brushes are read
+class BrushBatch(object):
+
+    # Planes of the unit cube, from which each brush is built
+    UNIT_PLANES = array([
+            [[1, 1, 1, 1], [1, 0, 1, 1], [0, 1, 1, 1]],
+            [[1, 1, 1, 1], [0, 1, 1, 1], [1, 1, 0, 1]],
+            [[1, 1, 1, 1], [1, 1, 0, 1], [1, 0, 1, 1]],
+            [[0, 0, 0, 1], [1, 0, 0, 1], [0, 1, 0, 1]],
+            [[0, 0, 0, 1], [0, 0, 1, 1], [1, 0, 0, 1]],
+            [[0, 0, 0, 1], [0, 1, 0, 1], [0, 0, 1, 1]]],
+                        dtype=int)
+
+    def __init__(self, capacity=16):
+        self.planes = empty((capacity, 6, 3, 4))
+        self.transforms = empty((capacity, 4, 4))
+        self.transformed = zeros(capacity, dtype=bool)
+        self.texScales = empty((capacity, 2), dtype=int)
+        self.materials = []
+        self.ids = []
+        self.size = 0
+        # True if some transformations were not applied yet
+        self.pending = False
+
+
+    def __len__(self):
+        return self.size
+
+
+    # Grow the arrays to hold count more brushes
+    def _reserve(self, count):
+        size = self.size + count
+        capacity = len(self.planes)
+        if size <= capacity:
+            return
+        capacity = max(size, 2*capacity)
+        planes = empty((capacity, 6, 3, 4))
+        planes[:self.size] = self.planes[:self.size]
+        transforms = empty((capacity, 4, 4))
+        transforms[:self.size] = self.transforms[:self.size]
+        transformed = zeros(capacity, dtype=bool)
+        transformed[:self.size] = self.transformed[:self.size]
+        texScales = empty((capacity, 2), dtype=int)
+        texScales[:self.size] = self.texScales[:self.size]
+        self.planes = planes
+        self.transforms = transforms
+        self.transformed = transformed
+        self.texScales = texScales
+
+
+    # Add a unit cube brush for each id. Return the slice
+    # selecting the new brushes
+    def extend(self, ids, material=None, texX=1, texY=1):
+        if material is None:
+            material = "NULL"
+        count = len(ids)
+        self._reserve(count)
+        sel = slice(self.size, self.size+count)
+        self.planes[sel] = BrushBatch.UNIT_PLANES
+        self.transforms[sel] = identity(4)
+        self.transformed[sel] = False
+        self.texScales[sel] = (texX, texY)
+        self.materials.extend([material]*count)
+        self.ids.extend(ids)
+        self.size += count
+        return sel
+
+
+    # Add a unit cube brush, return its index
+    def add(self, _id, material=None, texX=1, texY=1):
+        return self.extend([_id], material, texX, texY).start
+
+
+    # Return the planes of a box of the given size, with a
+    # corner in the origin
+    @staticmethod
+    def box(x, y, z):
+        return BrushBatch.UNIT_PLANES * array([x, y, z, 1])
+
+
+    # Add a copy of the prototype planes for each id, moved by
+    # the matching offset (an array of (x, y, z) rows). Return
+    # the slice selecting the new brushes
+    def instance(self, ids, prototype, offsets, material=None,
+                 texX=1, texY=1):
+        sel = self.extend(ids, material, texX, texY)
+        self.planes[sel] = prototype
+        self.planes[sel, ..., :3] += \
+            asarray(offsets)[:, newaxis, newaxis, :]
+        return sel
+
+
+    # Return the 4x4 matrix of a transformation, built from the
+    # (x, y, z) vector. Arrays give a different matrix for each
+    # selected brush
+    @staticmethod
+    def _matrix(x, y, z, scale):
+        if isscalar(x) and isscalar(y) and isscalar(z):
+            matrix = identity(4)
+            if scale:
+                matrix[0, 0], matrix[1, 1], matrix[2, 2] = x, y, z
+            else:
+                matrix[:3, 3] = x, y, z
+            return matrix
+        vector = stack(broadcast_arrays(x, y, z), axis=-1)
+        matrix = zeros(vector.shape[:-1] + (4, 4))
+        matrix[..., [0, 1, 2, 3], [0, 1, 2, 3]] = 1
+        if scale:
+            matrix[..., [0, 1, 2], [0, 1, 2]] = vector
+        else:
+            matrix[..., :3, 3] = vector
+        return matrix
+
+
+    def _compose(self, sel, matrix):
+        self.transforms[sel] = matmul(matrix, self.transforms[sel])
+        self.transformed[sel] = True
+        self.pending = True
+
+
+    def scale(self, sel, x, y, z):
+        self._compose(sel, BrushBatch._matrix(x, y, z, True))
+
+
+    def translate(self, sel, x, y, z):
+        self._compose(sel, BrushBatch._matrix(x, y, z, False))
+
+
+    # Apply the pending transformations
+    def flush(self):
+        if not self.pending:
+            return
+        rows = flatnonzero(self.transformed[:self.size])
+        # Points are row vectors: multiply them by the transposed
+        # matrices
+        matrices = self.transforms[rows].transpose(0, 2, 1)
+        self.planes[rows] = matmul(self.planes[rows],
+                                   matrices[:, newaxis])
+        self.transforms[rows] = identity(4)
+        self.transformed[rows] = False
+        self.pending = False
+
+
+    # Return the corners (mins, maxs) of the box bounding a brush
+    def bounds(self, i):
+        self.flush()
+        points = self.planes[i, ..., :3].reshape(-1, 3)
+        return tuple(points.min(axis=0).tolist()), \
+            tuple(points.max(axis=0).tolist())
+
+
+    # Merge the boxes among the selected brushes (a sequence of
+    # indices) with the same material and textures scales, when
+    # their union is a box: boxes with the same section along an
+    # axis, one ending exactly where the other starts, and
+    # duplicated boxes. Merged boxes are merged again until no
+    # more boxes can be merged. Brushes which aren't boxes are
+    # left as they are. Return the indices of the remaining
+    # brushes, in their order: a merged box takes the place of
+    # its first brush
+    def mergeBoxes(self, rows):
+        self.flush()
+        boxes = {}
+        for i in rows:
+            mins, maxs = self.bounds(i)
+            planes = BrushBatch.box(*[b-a for a, b in zip(mins, maxs)])
+            planes[..., :3] += mins
+            if array_equal(planes, self.planes[i]):
+                boxes[i] = (list(mins), list(maxs))
+
+        removed = set()
+        merged = True
+        while merged:
+            merged = False
+            for axis in range(3):
+                a1, a2 = [a for a in range(3) if a != axis]
+                runs = {}
+                for i, (mins, maxs) in boxes.items():
+                    key = (self.materials[i],
+                           tuple(self.texScales[i].tolist()),
+                           mins[a1], maxs[a1], mins[a2], maxs[a2])
+                    runs.setdefault(key, []).append(i)
+                for run in runs.values():
+                    if len(run) < 2:
+                        continue
+                    run.sort(key=lambda i: (boxes[i][0][axis],
+                                            boxes[i][1][axis], i))
+                    first = run[0]
+                    for i in run[1:]:
+                        firstMins, firstMaxs = boxes[first]
+                        mins, maxs = boxes[i]
+                        if mins[axis] == firstMaxs[axis]:
+                            # Adjacent boxes
+                            firstMaxs[axis] = maxs[axis]
+                        elif mins[axis] != firstMins[axis] or \
+                                maxs[axis] != firstMaxs[axis]:
+                            first = i
+                            continue
+                        # The first brush of the two is kept
+                        del boxes[i]
+                        if i < first:
+                            boxes[i] = boxes.pop(first)
+                            removed.add(first)
+                            first = i
+                        else:
+                            removed.add(i)
+                        merged = True
+
+        for i, (mins, maxs) in boxes.items():
+            self.planes[i] = BrushBatch.box(*[b-a for a, b
+                                              in zip(mins, maxs)])
+            self.planes[i, ..., :3] += mins
+        return [i for i in rows if i not in removed]
+
+
+    # Return the handles of the selected brushes
+    def brushes(self, sel):
+        return [Brush(self.ids[i], batch=self, index=i)
+                for i in range(*sel.indices(self.size))]
+
+
+    # Template of a brush code
+    BRUSH_TEMPLATE = '{\n' + \
+        ('( %s %s %s ) '*3 + '%s 0 0 0 %d %d\n')*6 + '}'
+
+    # Return the values filling the template of each selected
+    # brush (a sequence of indices). Coordinates are truncated to
+    # integers
+    def _brushValues(self, rows):
+        self.flush()
+        rows = asarray(rows, dtype=int)
+        count = len(rows)
+        # Maps share most of their coordinates: only the distinct
+        # ones are converted to text
+        coords = self.planes[rows, ..., :3].astype(int)
+        coords, inverse = unique(coords, return_inverse=True)
+        texts = array([str(c) for c in coords.tolist()],
+                      dtype=object)
+        # Each plane line holds the 9 coordinates of its points,
+        # the material and the textures scales
+        values = empty((count, 6, 12), dtype=object)
+        values[..., :9] = texts[inverse].reshape(count, 6, 9)
+        values[..., 9] = array([self.materials[i] for i in rows],
+                               dtype=object)[:, newaxis]
+        values[..., 10:] = self.texScales[rows, newaxis]
+        return values.reshape(count, 72).tolist()
+
+
+    # Format the selected brushes in a single pass: the values of
+    # all the brushes are gathered in one array, and formatted
+    # with one template for the whole selection. Each brush is
+    # preceded by its prefix (if given) and followed by suffix
+    def formatBrushes(self, rows, prefixes=None, suffix=''):
+        if len(rows) == 0:
+            return ''
+        values = self._brushValues(rows)
+        template = BrushBatch.BRUSH_TEMPLATE + suffix.replace('%', '%%')
+        if prefixes is not None:
+            template = '%s' + template
+            values = [[prefix] + v
+                      for prefix, v in zip(prefixes, values)]
+        return (template*len(values)) % \
+            tuple(chain.from_iterable(values))
+
+
+    # Return the code of each selected brush, gathering their
+    # values in a single pass
+    def brushStrs(self, rows):
+        if len(rows) == 0:
+            return []
+        template = BrushBatch.BRUSH_TEMPLATE
+        return [template % tuple(v) for v in self._brushValues(rows)]
+
+
+    def brushStr(self, i):
+        return self.formatBrushes([i])
+
+
+    # Format brush entities (entities with a brush of this batch,
+    # and a format() method filling their template with its
+    # code), formatting all their brushes in a single pass. Each
+    # entity is followed by suffix
+    def formatEntities(self, entities, suffix=''):
+        codes = self.brushStrs([entity.brush.index
+                                for entity in entities])
+        return ''.join([entity.format(code) + suffix
+                        for entity, code in zip(entities, codes)])
+
+
+# Handle of a brush stored in a BrushBatch. Brushes created
+# without a batch are stored in a batch of their own
 class Brush(object):
         
     def __init__(self, _id, material=None, planes=None,
-                 texX=1, texY=1):
+                 texX=1, texY=1, batch=None, index=None):
         self.id = _id
-        if material is None:
-            self.material = "NULL"
-        else:
-            self.material = material
+        if batch is None:
+            batch = BrushBatch(1)
+        if index is None:
+            index = batch.add(_id, material, texX, texY)
+        self.batch = batch
+        self.index = index
         if planes is not None:
-            self.planes = planes
-        else:
-            self.planes = [
-                [array([1, 1, 1, 1]), array([1, 0, 1, 1]),
-                 array([0, 1, 1, 1])],
-                [array([1, 1, 1, 1]), array([0, 1, 1, 1]),
-                 array([1, 1, 0, 1])],
-                [array([1, 1, 1, 1]), array([1, 1, 0, 1]),
-                 array([1, 0, 1, 1])],
-                [array([0, 0, 0, 1]), array([1, 0, 0, 1]),
-                 array([0, 1, 0, 1])],
-                [array([0, 0, 0, 1]), array([0, 0, 1, 1]),
-                 array([1, 0, 0, 1])],
-                [array([0, 0, 0, 1]), array([0, 1, 0, 1]),
-                 array([0, 0, 1, 1])]
-                ]
-            
-        self.texX = texX
-        self.texY = texY
+            batch.flush()
+            batch.planes[index] = planes
 
 
     def scale(self, x, y, z):
-        scaleMat = array([[x, 0, 0, 0],
-                          [0, y, 0, 0],
-                          [0, 0, z, 0],
-                          [0, 0, 0, 1]])
-        for plane in self.planes:
-            plane[0] = dot(plane[0], scaleMat)
-            plane[1] = dot(plane[1], scaleMat)
-            plane[2] = dot(plane[2], scaleMat)
+        self.batch.scale(self.index, x, y, z)
 
     
     def translate(self, x, y, z):
-        transMat = array([[1, 0, 0, 0],
-                          [0, 1, 0, 0],
-                          [0, 0, 1, 0],
-                          [x, y, z, 1]])
-        for plane in self.planes:
-            plane[0] = dot(plane[0], transMat)
-            plane[1] = dot(plane[1], transMat)
-            plane[2] = dot(plane[2], transMat)      
+        self.batch.translate(self.index, x, y, z)
 
 
     def __str__(self):
-        retVal = '{\n'
-        for plane in self.planes:
-            retVal += ''.join(['( %d %d %d ) ' % (v[0], v[1], v[2])
-                               for v in plane])
-            retVal += '%s 0 0 0 %d %d\n' % \
-                (self.material, self.texX, self.texY)
-        return retVal + '}'
+        return self.batch.brushStr(self.index)
 
 
 class MovableEntity(object):
@@ -74,9 +338,20 @@ class MovableEntity(object):
         self.id = _id
         if x is not None and \
                 y is not None and z is not None:
-            self.pos = array([x, y, z, 1])
+            self._pos = array([x, y, z, 1])
         else:
-            self.pos = array([25, 25, 25, 1])
+            self._pos = array([25, 25, 25, 1])
+        # Translations are composed, and applied when the
+        # position is read
+        self.transform = None
+
+
+    @property
+    def pos(self):
+        if self.transform is not None:
+            self._pos = dot(self._pos, self.transform)
+            self.transform = None
+        return self._pos
         
 
     def translate(self, x, y, z):
@@ -84,13 +359,22 @@ class MovableEntity(object):
                           [0, 1, 0, y],
                           [0, 0, 1, z],
                           [0, 0, 0, 1]])
-        self.pos = dot(self.pos, transMat)
+        if self.transform is None:
+            self.transform = transMat
+        else:
+            self.transform = dot(self.transform, transMat)
 
 
 
 class Door(Brush):
 
-    def __str__(self):
+    # A door is its own brush
+    @property
+    def brush(self):
+        return self
+
+
+    def format(self, brushCode):
         retVal = '''
 {
 "classname" "func_door"
@@ -98,43 +382,22 @@ class Door(Brush):
 "angle" "90"
 "wait" "-1"
 ''' % self.id
-        retVal += super(Door, self).__str__()
+        retVal += brushCode
         retVal += '\n}\n'
         return retVal
 
 
-class Player(MovableEntity):
-
-    def __init__(self, _id, x=None, y=None, z=None,
-                 isCoop=False):
-        super(Player, self).__init__(_id, x, y, z)
-        self.isCoop = isCoop
-
-
     def __str__(self):
-        if not self.isCoop:
-            retVal = '''{
-"classname" "info_player_start"
-"origin" "%d %d %d"
-}
-''' % (self.pos[0], self.pos[1], self.pos[2])
-        else:
-            retVal = '''{
-"classname" "info_player_coop"
-"origin" "%d %d %d"
-}
-''' % (self.pos[0], self.pos[1], self.pos[2])            
-        return retVal
-
+        return self.format(super(Door, self).__str__())
 
 
 class Trigger(MovableEntity):
 
     def __init__(self, _id, x=None, y=None, z=None,
                  delay=0, message='',
-                 isCounter=False, count=0):
+                 isCounter=False, count=0, batch=None):
         super(Trigger, self).__init__(_id, x, y, z)
-        self.brush = Brush(self.id+"_brush")
+        self.brush = Brush(self.id+"_brush", batch=batch)
         self.delay = delay
         self.message = message
         self.isCounter = isCounter
@@ -146,7 +409,7 @@ class Trigger(MovableEntity):
         self.brush.translate(x, y, z)
 
 
-    def __str__(self):
+    def format(self, brushCode):
         if self.isCounter is False:
             retVal = '''{
 "classname" "trigger_once"
@@ -155,7 +418,7 @@ class Trigger(MovableEntity):
 "message" "%s"
 %s
 }
-''' % (self.id, self.delay, self.message, str(self.brush))
+''' % (self.id, self.delay, self.message, brushCode)
         else:
             # Trigger only used for display the message
             # for trigger conters
@@ -167,7 +430,7 @@ class Trigger(MovableEntity):
 "spawnflags" "1"
 %s
 }
-''' % (self.id, self.id, self.message, str(self.brush))
+''' % (self.id, self.id, self.message, brushCode)
             retVal += '''{
 "classname" "trigger_counter"
 "origin" "%d %d %d"
@@ -193,12 +456,17 @@ class Trigger(MovableEntity):
         return retVal
 
 
+    def __str__(self):
+        return self.format(str(self.brush))
+
+
 class ChangeLevelTrigger(MovableEntity):
 
-    def __init__(self, _id, x=None, y=None, z=None):
+    def __init__(self, _id, x=None, y=None, z=None,
+                 batch=None):
         super(ChangeLevelTrigger, self).__init__(_id,
                                                  x, y, z)
-        self.brush = Brush(self.id+"_brush")
+        self.brush = Brush(self.id+"_brush", batch=batch)
 
 
     def translate(self, x, y, z):
@@ -206,24 +474,32 @@ class ChangeLevelTrigger(MovableEntity):
         self.brush.translate(x, y, z)
 
 
-    def __str__(self):
+    def format(self, brushCode):
         retVal = '''{
 "classname" "trigger_changelevel"
 "map" "%s"
 %s
 }
-''' % (self.id.replace(' ', '_'), str(self.brush))
+''' % (self.id.replace(' ', '_'), brushCode)
         return retVal
 
 
+    def __str__(self):
+        return self.format(str(self.brush))
+
+
 class MonsterTrigger(MovableEntity):
     
     def __init__(self, _id, hordeName,
-                 x=None, y=None, z=None, delay=0):
+                 x=None, y=None, z=None, delay=0,
+                 brush=None):
         super(MonsterTrigger, self).__init__(_id, x, y, z)
         self.hordName = hordeName
         self.delay = delay
-        self.brush = Brush(self.id+"_brush")
+        if brush is not None:
+            self.brush = brush
+        else:
+            self.brush = Brush(self.id+"_brush")
     
 
     def translate(self, x, y, z):
@@ -231,7 +507,7 @@ class MonsterTrigger(MovableEntity):
         self.brush.translate(x, y, z)
 
 
-    def __str__(self):
+    def format(self, brushCode):
         retVal = '''{
 "classname" "trigger_once"
 "targetname" "%s_trigger"
@@ -239,10 +515,14 @@ class MonsterTrigger(MovableEntity):
 "spawnflags" "1"
 %s
 }
-''' % (self.hordName, self.id, str(self.brush))
+''' % (self.hordName, self.id, brushCode)
         return retVal
 
 
+    def __str__(self):
+        return self.format(str(self.brush))
+
+
 
 class MonsterTeleport(MovableEntity):
 
@@ -257,7 +537,7 @@ class MonsterTeleport(MovableEntity):
         self.brush.translate(x, y, z)
 
 
-    def __str__(self):
+    def format(self, brushCode):
         retVal = '''{
 "classname" "trigger_teleport"
 "target" "%s_destination"
@@ -265,173 +545,270 @@ class MonsterTeleport(MovableEntity):
 // brush
 %s
 }
-''' % (self.id, self.id, str(self.brush))
+''' % (self.id, self.id, brushCode)
         return retVal
 
 
-
-class MonsterDestination(MovableEntity):
-
     def __str__(self):
-        retVal = '''{
-"classname" "info_teleport_destination"
-"origin" "%d %d %d"
-"angle" "180"
-"targetname" "%s_destination"
-}
-''' % (self.pos[0], self.pos[1], self.pos[2], self.id)
-        return retVal
+        return self.format(str(self.brush))
 
 
-class MonsterEntity(MovableEntity):
+# Point entities of a map, stored by columns: each entity is a
+# row of the table. Entities are written with the template of
+# their kind, filled with the kind fields
+class EntityTable(object):
 
-    def __init__(self, _id, _type, 
-                 x=None, y=None, z=None,
-                 target=None):
-        super(MonsterEntity, self).__init__(_id, x, y, z)
-        self.type = _type
-        self.target = target
-    
+    (PLAYER, DESTINATION, MONSTER, ITEM, FLAGGED_ITEM,
+     FLAME) = range(6)
 
-    def __str__(self):
-        if self.type == 'zombie':
-            spawnFlag=2
-        else:
-            spawnFlag=1
-        retVal = '''{
-"classname" "monster_%s"
-"origin" "%s %s %s"
+    TEMPLATES = {PLAYER:'''{
+"classname" "%s"
+"origin" "%d %d %d"
+}
+''',
+                 DESTINATION:'''{
+"classname" "%s"
+"origin" "%d %d %d"
+"angle" "180"
+"targetname" "%s"
+}
+''',
+                 MONSTER:'''{
+"classname" "%s"
+"origin" "%d %d %d"
 "spawnflags" "%d"
 "target" "%s"
 "targetname" "%s"
 }
-''' % (self.type, self.pos[0], self.pos[1], self.pos[2],
-       spawnFlag, self.target, self.id)
-        return retVal
+''',
+                 ITEM:'''{
+"classname" "%s"
+"origin" "%d %d %d"
+}
+''',
+                 FLAGGED_ITEM:'''{
+"classname" "%s"
+"origin" "%d %d %d"
+"spawnflag" "%d"
+}
+''',
+                 FLAME:'''{
+"classname" "%s"
+"origin" "%d %d %d"
+"light" %d
+}
+'''}
+
+    FIELDS = {PLAYER:('classname', 'origin'),
+              DESTINATION:('classname', 'origin', 'targetname'),
+              MONSTER:('classname', 'origin', 'spawnflags',
+                       'target', 'targetname'),
+              ITEM:('classname', 'origin'),
+              FLAGGED_ITEM:('classname', 'origin', 'spawnflags'),
+              FLAME:('classname', 'origin', 'light')}
+
+    def __init__(self, capacity=64):
+        self.kinds = []
+        self.ids = []
+        self.classnames = []
+        self.targetnames = []
+        self.targets = []
+        self.origins = empty((capacity, 3))
+        self.spawnflags = empty(capacity, dtype=int)
+        self.lights = empty(capacity, dtype=int)
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def _reserve(self, count):
+        size = self.size + count
+        capacity = len(self.origins)
+        if size <= capacity:
+            return
+        capacity = max(size, 2*capacity)
+        origins = empty((capacity, 3))
+        origins[:self.size] = self.origins[:self.size]
+        spawnflags = empty(capacity, dtype=int)
+        spawnflags[:self.size] = self.spawnflags[:self.size]
+        lights = empty(capacity, dtype=int)
+        lights[:self.size] = self.lights[:self.size]
+        self.origins = origins
+        self.spawnflags = spawnflags
+        self.lights = lights
+
+
+    # Add an entity, return its index
+    def add(self, kind, _id, classname, x, y, z,
+            targetname='', target='', spawnflags=0, light=0):
+        self._reserve(1)
+        index = self.size
+        self.kinds.append(kind)
+        self.ids.append(_id)
+        self.classnames.append(classname)
+        self.targetnames.append(targetname)
+        self.targets.append(target)
+        self.origins[index] = (x, y, z)
+        self.spawnflags[index] = spawnflags
+        self.lights[index] = light
+        self.size += 1
+        return index
+
+
+    def addPlayer(self, _id, x, y, z, isCoop=False):
+        if not isCoop:
+            classname = 'info_player_start'
+        else:
+            classname = 'info_player_coop'
+        return self.add(EntityTable.PLAYER, _id, classname,
+                        x, y, z)
 
 
-class Health(MovableEntity):
+    def addDestination(self, _id, x, y, z):
+        return self.add(EntityTable.DESTINATION, _id,
+                        'info_teleport_destination', x, y, z,
+                        targetname=_id+'_destination')
 
-    def __init__(self, _id, size,
-                 x=None, y=None, z=None):
-        super(Health, self).__init__(_id, x, y, z)
-        self.size = size
 
+    def addMonster(self, _id, _type, x, y, z, target):
+        if _type == 'zombie':
+            spawnFlag = 2
+        else:
+            spawnFlag = 1
+        return self.add(EntityTable.MONSTER, _id,
+                        'monster_'+_type, x, y, z,
+                        targetname=_id, target=target,
+                        spawnflags=spawnFlag)
 
-    def __str__(self):
-        if self.size == 'small':
+
+    def addHealth(self, _id, size, x, y, z):
+        if size == 'small':
             spawnflag = 0
-        elif self.size == 'medium':
+        elif size == 'medium':
             spawnflag = 1
         else:
             spawnflag = 2
+        return self.add(EntityTable.FLAGGED_ITEM, _id,
+                        'item_health', x, y, z,
+                        spawnflags=spawnflag)
 
-        retVal = '''{
-"classname" "item_health"
-"origin" "%d %d %d"
-"spawnflag" "%d"
-}
-''' % (self.pos[0], self.pos[1], self.pos[2], spawnflag)
-        return retVal
-
-
-class Armor(MovableEntity):
 
-    def __init__(self, _id, size,
-                 x=None, y=None, z=None):
-        super(Armor, self).__init__(_id, x, y, z)
-        self.size = size
-
-
-    def __str__(self):
-        if self.size == 'small':
+    def addArmor(self, _id, size, x, y, z):
+        if size == 'small':
             armName = 'armor1'
-        elif self.size == 'medium':
+        elif size == 'medium':
             armName = 'armor2'
         else:
             armName = 'armorInv'
-
-        retVal = '''{
-"classname" "item_%s"
-"origin" "%d %d %d"
-}
-''' % (armName, self.pos[0], self.pos[1], self.pos[2])
-        return retVal
-
-
-class Artifact(MovableEntity):
-
-    def __init__(self, _id, _type,
-                 x=None, y=None, z=None):
-        super(Artifact, self).__init__(_id, x, y, z)
-        self.type = _type
-
-
-    def __str__(self):
-        retVal = '''{
-"classname" "item_artifact_%s"
-"origin" "%d %d %d"
-}
-''' % (self.type, self.pos[0], self.pos[1], self.pos[2])
-        return retVal
+        return self.add(EntityTable.ITEM, _id, 'item_'+armName,
+                        x, y, z)
 
 
-class Ammo(MovableEntity):
+    def addArtifact(self, _id, _type, x, y, z):
+        return self.add(EntityTable.ITEM, _id,
+                        'item_artifact_'+_type, x, y, z)
 
-    def __init__(self, _id, _type, size,
-                 x=None, y=None, z=None):
-        super(Ammo, self).__init__(_id, x, y, z)
-        self.type = _type
-        self.size = size
 
-    def __str__(self):
-        if self.size == 'small':
+    def addAmmo(self, _id, _type, size, x, y, z):
+        if size == 'small':
             spawnflag = 0
         else:
             spawnflag = 1
-
-        retVal = '''{
-"classname" "item_%s"
-"origin" "%d %d %d"
-"spawnflag" "%d"
-}
-''' % (self.type, self.pos[0], self.pos[1], self.pos[2],
-       spawnflag)
-        return retVal
-
-
-class Weapon(MovableEntity):
-
-    def __init__(self, _id, _type,
-                 x=None, y=None, z=None):
-        super(Weapon, self).__init__(_id, x, y, z)
-        self.type = _type
-
-
-    def __str__(self):
-        retVal = '''{
-"classname" "weapon_%s"
-"origin" "%d %d %d"
-}
-''' % (self.type, self.pos[0], self.pos[1], self.pos[2])
-        return retVal
-
-
-class Flame(MovableEntity):
-
-    def __init__(self, _id, _type, brightness=2,
-                 x=None, y=None, z=None):
-        super(Flame, self).__init__(_id, x, y, z)
-        self.type = _type
-        self.brightness = brightness
-
-
-    def __str__(self):
-        retVal = '''{
-"classname" "light_%s"
-"origin" "%d %d %d"
-"light" %d
-}
-''' % (self.type, self.pos[0], self.pos[1], self.pos[2],
-       self.brightness)
-        return retVal
+        return self.add(EntityTable.FLAGGED_ITEM, _id,
+                        'item_'+_type, x, y, z,
+                        spawnflags=spawnflag)
+
+
+    def addWeapon(self, _id, _type, x, y, z):
+        return self.add(EntityTable.ITEM, _id, 'weapon_'+_type,
+                        x, y, z)
+
+
+    def addFlame(self, _id, _type, brightness, x, y, z):
+        return self.add(EntityTable.FLAME, _id, 'light_'+_type,
+                        x, y, z, light=brightness)
+
+
+    # Move the selected entities (an index, a slice or an array
+    # of indices). Arrays give a different offset to each entity
+    def translate(self, sel, x, y, z):
+        self.origins[sel] += stack(broadcast_arrays(x, y, z),
+                                   axis=-1)
+
+
+    # Write the selected entities (a sequence of indices) with a
+    # single template. Origins are truncated to integers
+    def formatEntities(self, rows):
+        rows = list(rows)
+        if not rows:
+            return ''
+        columns = {'classname':[self.classnames[i] for i in rows],
+                   'origin':self.origins[rows].astype(int).tolist(),
+                   'targetname':[self.targetnames[i] for i in rows],
+                   'target':[self.targets[i] for i in rows],
+                   'spawnflags':self.spawnflags[rows].tolist(),
+                   'light':self.lights[rows].tolist()}
+        templates = []
+        values = []
+        for j, i in enumerate(rows):
+            kind = self.kinds[i]
+            templates.append(EntityTable.TEMPLATES[kind])
+            for field in EntityTable.FIELDS[kind]:
+                if field == 'origin':
+                    values.extend(columns[field][j])
+                else:
+                    values.append(columns[field][j])
+        return ''.join(templates) % tuple(values)
+
+
+    def entityStr(self, i):
+        return self.formatEntities([i])
+
+
+# Uniform grid over axis-aligned boxes, to find the boxes
+# overlapping each other without comparing all the pairs. Each
+# box is stored in the (x, y) cells it covers, and it's compared
+# only with the boxes sharing a cell with it
+class SpatialGrid(object):
+
+    def __init__(self, cellSize=64):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.boxes = {}
+
+
+    def _cells(self, mins, maxs):
+        size = float(self.cellSize)
+        for x in range(int(floor(mins[0]/size)),
+                       int(floor(maxs[0]/size))+1):
+            for y in range(int(floor(mins[1]/size)),
+                           int(floor(maxs[1]/size))+1):
+                yield x, y
+
+
+    # Return the keys of the stored boxes overlapping the given
+    # box, in keys order. Boxes just touching don't overlap. If
+    # limit is given, the search stops after finding that many
+    # boxes
+    def overlaps(self, mins, maxs, limit=None):
+        found = set()
+        for cell in self._cells(mins, maxs):
+            for key in self.cells.get(cell, ()):
+                if key in found:
+                    continue
+                boxMins, boxMaxs = self.boxes[key]
+                if mins[0] < boxMaxs[0] and maxs[0] > boxMins[0] and \
+                        mins[1] < boxMaxs[1] and maxs[1] > boxMins[1] and \
+                        mins[2] < boxMaxs[2] and maxs[2] > boxMins[2]:
+                    found.add(key)
+                    if len(found) == limit:
+                        return sorted(found)
+        return sorted(found)
+
+
+    def insert(self, key, mins, maxs):
+        self.boxes[key] = (mins, maxs)
+        for cell in self._cells(mins, maxs):
+            self.cells.setdefault(cell, []).append(key)
@@ -0,0 +1,147 @@
+#*************************************************
+# bsp.py
+#
+# Helpers to update the compiled maps (.bsp files)
+# without running the map compiler again
+#*************************************************
+import os
+import re
+import mmap
+import struct
+
+# Versions of the supported .bsp formats. All of them start with
+# the version and the entities lump (offset and length)
+BSP_VERSIONS = (struct.pack('<i', 29), 'BSP2', '2PSB')
+BSP_HEADER = struct.Struct('<4sii')
+
+# Tokens of the .map code: comments, quoted strings (which may
+# span lines), braces, brush planes and bare values (as the
+# flames light)
+_TOKEN = re.compile(r'''\s*(?:
+    (//[^\n]*)
+  | "([^"]*)"
+  | ([{}])
+  | (\([^\n]*)
+  | ([^\s{}"]+)
+)''', re.VERBOSE)
+_COMMENT, _QUOTED, _BRACE, _PLANE, _BARE = range(1, 6)
+
+
+# Split the .map code into its entities. Each entity is returned
+# as its list of (key, value) pairs and the list of its brushes
+# code. Return None if the code can't be parsed
+def ParseMap(code):
+    entities = []
+    depth = 0
+    key = None
+    pos = 0
+    end = len(code.rstrip())
+    while pos < end:
+        m = _TOKEN.match(code, pos)
+        if m is None:
+            return None
+        pos = m.end()
+        group = m.lastindex
+        if group == _COMMENT:
+            continue
+        token = m.group(group)
+        if key is not None:
+            # Value of the last key
+            if group not in (_QUOTED, _BARE):
+                return None
+            pairs.append((key, token))
+            key = None
+        elif token == '{' and group == _BRACE:
+            depth += 1
+            if depth == 1:
+                pairs = []
+                brushes = []
+                entities.append((pairs, brushes))
+            elif depth == 2:
+                brush = []
+            else:
+                return None
+        elif token == '}' and group == _BRACE:
+            if depth == 2:
+                brushes.append('\n'.join(brush))
+            elif depth != 1:
+                return None
+            depth -= 1
+        elif depth == 1 and group == _QUOTED:
+            key = token
+        elif depth == 2 and group == _PLANE:
+            brush.append(token.strip())
+        else:
+            return None
+    if depth != 0 or key is not None:
+        return None
+    return entities
+
+
+# Return the code of the entities which the map compiler turns
+# into geometry: the worldspawn, the brush entities and (if the
+# map is lit) the lights. The entities lump of a .bsp can be
+# patched as long as this code doesn't change
+def MapGeometry(entities, lit=False):
+    chunks = []
+    for pairs, brushes in entities:
+        classname = dict(pairs).get('classname', '')
+        if classname == 'worldspawn' or \
+                (lit and classname.startswith('light')):
+            chunks.extend('"%s" "%s"' % pair for pair in pairs)
+        elif brushes:
+            chunks.append(classname)
+        chunks.extend(brushes)
+    return '\n'.join(chunks)
+
+
+# Return the entities lump written by the map compiler: brush
+# entities refer to their model in the .bsp, numbered in order
+# (the worldspawn is model 0)
+def EntityLump(entities):
+    chunks = []
+    model = 0
+    for pairs, brushes in entities:
+        chunks.append('{\n')
+        chunks.extend('"%s" "%s"\n' % pair for pair in pairs)
+        if brushes and dict(pairs).get('classname') != 'worldspawn':
+            model += 1
+            chunks.append('"model" "*%d"\n' % model)
+        chunks.append('}\n')
+    chunks.append('\0')
+    return ''.join(chunks)
+
+
+# Replace the entities lump of a .bsp file. The new lump is
+# written in place if it fits (or if it is the last one),
+# otherwise it is appended to the file. Return False if the
+# file format is not supported
+def PatchEntityLump(fileName, lump):
+    with open(fileName, 'r+b') as f:
+        version, offset, length = \
+            BSP_HEADER.unpack(f.read(BSP_HEADER.size))
+        if version not in BSP_VERSIONS:
+            return False
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if offset + length == size:
+            # Last lump: resize the file
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(lump)
+        elif len(lump) <= length:
+            data = mmap.mmap(f.fileno(), 0)
+            try:
+                # The old lump tail is cleared
+                data[offset:offset+length] = \
+                    lump + '\0'*(length-len(lump))
+            finally:
+                data.close()
+        else:
+            # Lumps are aligned to 4 bytes
+            offset = (size+3) & ~3
+            f.seek(offset)
+            f.write(lump)
+        f.seek(0)
+        f.write(BSP_HEADER.pack(version, offset, len(lump)))
+    return True
@@ -0,0 +1,153 @@
+#*************************************************
+# cache.py
+#
+# User-level cache shared by the QuakeHordes tools
+#*************************************************
+import os
+import shutil
+import hashlib
+from os import path, environ
+from tempfile import mkdtemp
+from threading import Lock
+
+# Default location of the cache. It can be moved using the
+# QUAKEHORDES_CACHE environment variable
+CACHE_ROOT = path.join('~', '.quakehordes', 'cache')
+
+
+# Return the cache subdirectory name, creating it if needed
+def GetCacheDir(name):
+    root = path.expanduser(environ.get('QUAKEHORDES_CACHE',
+                                       CACHE_ROOT))
+    cacheDir = path.join(root, name)
+    if not path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            # Another worker may have created it meanwhile
+            if not path.isdir(cacheDir):
+                raise
+    return cacheDir
+
+
+# Hash the given strings in order
+def HashContent(*chunks):
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Move a fully written temporary file on its final name, so
+# that concurrent readers never see a partial file
+def CommitFile(tmpName, fileName):
+    try:
+        os.rename(tmpName, fileName)
+    except OSError:
+        # Windows does not replace existing files: keep the
+        # one already published by another worker
+        if not path.exists(fileName):
+            raise
+        os.remove(tmpName)
+
+
+# Cache of build artifacts (as the compiled maps), stored by
+# key as one directory holding a file for each extension. The
+# least recently used entries are evicted once the cache grows
+# over maxSize bytes. Each instance counts its hits, misses and
+# evictions. The cache can be shared by several threads
+class ArtifactCache(object):
+
+    # Default size, in bytes
+    DEFAULT_SIZE = 512*1024*1024
+
+    def __init__(self, name, exts, maxSize=DEFAULT_SIZE):
+        self.cacheDir = GetCacheDir(name)
+        self.exts = exts
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+    # Return True if artifacts are cached under key. The lookup
+    # is not counted
+    def contains(self, key):
+        return path.isdir(path.join(self.cacheDir, key))
+
+
+    # Count a lookup of artifacts which are not cached
+    def missed(self):
+        self._count('misses')
+
+
+    # Copy the artifacts cached under key on baseName.<ext>.
+    # Return False if they are not cached
+    def restore(self, key, baseName):
+        entry = path.join(self.cacheDir, key)
+        try:
+            exts = os.listdir(entry)
+            for ext in self.exts:
+                fileName = baseName + '.' + ext
+                if ext in exts:
+                    shutil.copyfile(path.join(entry, ext), fileName)
+                elif path.exists(fileName):
+                    # Left by a previous build
+                    os.remove(fileName)
+            # Mark the entry as recently used
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # Missing entry, or evicted meanwhile by another worker
+            self._count('misses')
+            return False
+        self._count('hits')
+        return True
+
+
+    # Store the existing baseName.<ext> files under key, then
+    # evict the oldest entries if needed
+    def store(self, key, baseName):
+        entry = path.join(self.cacheDir, key)
+        tmpDir = mkdtemp(suffix='.tmp', dir=self.cacheDir)
+        try:
+            for ext in self.exts:
+                fileName = baseName + '.' + ext
+                if path.exists(fileName):
+                    shutil.copyfile(fileName, path.join(tmpDir, ext))
+            os.rename(tmpDir, entry)
+        except (IOError, OSError):
+            # Already stored by another worker, or no space left:
+            # caching is an optimization only
+            shutil.rmtree(tmpDir, True)
+            return
+        self.evict()
+
+
+    def evict(self):
+        entries = []
+        total = 0
+        for key in os.listdir(self.cacheDir):
+            entry = path.join(self.cacheDir, key)
+            if key.endswith('.tmp'):
+                continue
+            try:
+                size = sum(path.getsize(path.join(entry, ext))
+                           for ext in os.listdir(entry))
+                entries.append((path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total += size
+
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.maxSize:
+                break
+            shutil.rmtree(entry, True)
+            total -= size
+            self._count('evictions')
@@ -0,0 +1,159 @@
+#*************************************************
+# compiler.py
+#
+# Compiler for the Hordes Definition Language
+#*************************************************
+import cPickle as pickle
+from os import fdopen, path, remove
+from tempfile import mkstemp
+
+from scanner import QHDLScanner
+from parser import BuildQHDLParser, GRAMMAR_SIGNATURE
+from parser_internals import Env, Resolver
+from optimizer import Optimizer
+from cache import GetCacheDir, HashContent, CommitFile
+
+# Modules building the compiled sources (.qhc files): the AST
+# nodes, the resolver and the optimizer
+COMPILER_MODULES = ('parser', 'parser_internals', 'optimizer')
+
+
+# Version of the compiled sources format: a hash of the modules
+# sources, so that compiled sources are dropped as soon as one
+# of them changes
+def _compilerVersion():
+    chunks = []
+    for name in COMPILER_MODULES:
+        fileName = path.join(path.dirname(path.abspath(__file__)),
+                             name+'.py')
+        with open(fileName, 'rb') as f:
+            chunks.append(f.read())
+    return HashContent(*chunks)
+
+
+COMPILER_VERSION = _compilerVersion()
+
+
+# A compiler owns its scanner, its parser and the environment of
+# the last compiled source, so that it can be reused for many
+# sources and several compilers can run in different threads.
+# The optimizations done on the last parsed source are listed in
+# the report. Parsed sources are cached, unless useCache is
+# False: cacheHit tells if the last one was found in the cache
+class QHDLCompiler(object):
+
+    def __init__(self, optimize=True, useCache=True):
+        self.lexer = QHDLScanner()
+        self.parser = BuildQHDLParser()
+        self.optimize = optimize
+        self.useCache = useCache
+        self.env = None
+        self.report = []
+        self.cacheHit = None
+
+
+    def parse(self, code):
+        key = self._cacheKey(code)
+        ast = self._loadCached(key)
+        if ast is None:
+            # The scanner restarts line counting on each input
+            ast = self.parser.parse(code, lexer=self.lexer,
+                                    tracking=True)
+            ast = self._prepare(ast)
+            self._storeCached(key, ast)
+        return ast
+
+
+    # Parse a source file, scanning it straight from a memory
+    # map of the file
+    def parseFile(self, fileName):
+        self.lexer.inputFile(fileName)
+        try:
+            key = self._cacheKey(self.lexer.lexdata)
+            ast = self._loadCached(key)
+            if ast is not None:
+                return ast
+            ast = self.parser.parse(lexer=self.lexer,
+                                    tracking=True)
+        finally:
+            self.lexer.close()
+        ast = self._prepare(ast)
+        self._storeCached(key, ast)
+        return ast
+
+
+    # Resolve the variables addresses and optimize the AST
+    def _prepare(self, ast):
+        ast = Resolver().resolve(ast)
+        self.report = []
+        if self.optimize:
+            optimizer = Optimizer()
+            ast = optimizer.optimize(ast)
+            self.report = optimizer.report
+        return ast
+
+
+    # Compiled sources are keyed by their content and by the
+    # compiler which produced them
+    def _cacheKey(self, code):
+        if not self.useCache:
+            return None
+        return HashContent(COMPILER_VERSION, GRAMMAR_SIGNATURE,
+                           str(self.optimize), code)
+
+
+    def _cachedFile(self, key):
+        return path.join(GetCacheDir('qhc'), key+'.qhc')
+
+
+    # Return the AST of a compiled source, None if not cached
+    def _loadCached(self, key):
+        self.cacheHit = None
+        if key is None:
+            return None
+        try:
+            with open(self._cachedFile(key), 'rb') as f:
+                ast, report = pickle.load(f)
+        except Exception:
+            # Missing or damaged file: compile the source again
+            self.cacheHit = False
+            return None
+        self.cacheHit = True
+        self.report = report
+        return ast
+
+
+    def _storeCached(self, key, ast):
+        if key is None:
+            return
+        tmpName = None
+        try:
+            fileName = self._cachedFile(key)
+            fd, tmpName = mkstemp(suffix='.tmp',
+                                  dir=path.dirname(fileName))
+            with fdopen(fd, 'wb') as f:
+                pickle.dump((ast, self.report), f,
+                            pickle.HIGHEST_PROTOCOL)
+            CommitFile(tmpName, fileName)
+        except (IOError, OSError, pickle.PicklingError):
+            # Caching is an optimization only
+            if tmpName is not None and path.exists(tmpName):
+                remove(tmpName)
+
+
+    def execute(self, ast):
+        # Compile the resolved AST into python closures and run
+        # them on a fresh environment
+        code = ast.compile()
+        env = Env(ast.frameSizes, ast.cacheSize)
+        self.env = env
+        code(env)
+        return env
+
+
+    def compile(self, code):
+        return self.execute(self.parse(code))
+
+
+    def compileFile(self, fileName):
+        return self.execute(self.parseFile(fileName))
@@ -108,7 +108,16 @@ def t_error(t):
     raise QHDLLexError(t, t.lexer.lineno,
                       t.lexpos-t.lexer.startLinePos-1)
 
-# Build the lexer
+# Build the master lexer
 #lex.lex(debug=True)
-lex.lex()
-lex.startLinePos=0
+lexer = lex.lex()
+
+
+# Return a private lexer sharing the master lexer rules
+def BuildQHDLLexer():
+    newLexer = lexer.clone()
+    newLexer.lineno = 1
+    # Position of the last newline: the first line starts
+    # right after it
+    newLexer.startLinePos = -1
+    return newLexer
@@ -0,0 +1,251 @@
+#*************************************************
+# optimizer.py
+#
+# AST optimizer for the Hordes Definition Language.
+# It runs on the resolved AST: constant expressions
+# and conditions are folded, and the expressions
+# whose value can't change during a loop are
+# computed once for each run of the loop
+#*************************************************
+import operator
+
+from parser_internals import AstNode, AssignNode, \
+    MethodCallNode, PrintNode, ForNode, IfNode, VarNode, \
+    ExpNode, CondNode, CachedNode
+
+
+# Operators symbols, for the report
+OPERATORS = {operator.add:'+', operator.sub:'-',
+             operator.mul:'*', operator.div:'/',
+             operator.eq:'==', operator.ne:'!=',
+             operator.gt:'>', operator.ge:'>=',
+             operator.lt:'<', operator.le:'<=',
+             operator.and_:'and', operator.or_:'or',
+             operator.not_:'not'}
+
+
+# Return the source text of an expression
+def _exprStr(v):
+    if isinstance(v, ExpNode):
+        return '%s%s%s' % (_exprStr(v.childs[0]),
+                           OPERATORS[v.childs[2]],
+                           _exprStr(v.childs[1]))
+    elif isinstance(v, VarNode):
+        outStr = v.childs[0]
+        node = v
+        while node is not None:
+            if node is not v:
+                outStr += '.' + node.childs[0]
+            if node.childs[1] is not None:
+                outStr += '[%d]' % node.childs[1]
+            node = node.childs[2]
+        return outStr
+    elif isinstance(v, CachedNode):
+        return _exprStr(v.childs[0])
+    elif type(v) is str:
+        return '"%s"' % v
+    return str(v)
+
+
+def _isConst(v):
+    return not isinstance(v, AstNode)
+
+
+def _isNumber(v):
+    return type(v) is int or type(v) is float
+
+
+# Chain of the (name, offset) lookups performed by a variable
+def _lookups(varNode):
+    lookups = []
+    node = varNode
+    while node is not None:
+        lookups.append((node.childs[0], node.childs[1]))
+        node = node.childs[2]
+    return lookups
+
+
+# Side effects of a loop body: what its statements may change
+class LoopEffects(object):
+
+    def __init__(self, forNode):
+        self.forNode = forNode
+        # Depth of the loop body: variables declared at a
+        # lower depth live outside the loop
+        self.depth = forNode.addr[0]
+        # Variables and fields assigned in the body
+        self.addrs = set()
+        self.attrs = set()
+        # Method calls and assignments to list items change the
+        # lists content
+        self.lists = False
+        self.collect(forNode.childs[2:])
+
+
+    def collect(self, stmts):
+        for stmt in stmts:
+            if isinstance(stmt, AssignNode):
+                lookups = _lookups(stmt.childs[0].childs[0])
+                name, offset = lookups[-1]
+                if offset is not None:
+                    self.lists = True
+                elif len(lookups) > 1:
+                    self.attrs.add(name)
+                else:
+                    self.addrs.add(stmt.childs[0].childs[0].addr)
+            elif isinstance(stmt, MethodCallNode):
+                self.lists = True
+            elif isinstance(stmt, ForNode):
+                self.collect(stmt.childs[2:])
+            elif isinstance(stmt, IfNode):
+                self.collect(stmt.childs[1])
+                if stmt.childs[2] is not None:
+                    self.collect(stmt.childs[2])
+
+
+    # Return True if the value of the expression can't change
+    # during the loop
+    def isInvariant(self, v):
+        if _isConst(v):
+            return True
+        elif isinstance(v, ExpNode):
+            return self.isInvariant(v.childs[0]) and \
+                self.isInvariant(v.childs[1])
+        elif isinstance(v, VarNode):
+            if v.addr is None or v.addr[0] >= self.depth or \
+                    v.addr in self.addrs:
+                return False
+            lookups = _lookups(v)
+            for name, offset in lookups:
+                if offset is not None and self.lists:
+                    return False
+            for name, offset in lookups[1:]:
+                if name in self.attrs:
+                    return False
+            return True
+        return False
+
+
+class Optimizer(object):
+
+    def __init__(self):
+        self.report = []
+        self.cacheSize = 0
+
+
+    def optimize(self, program):
+        self.visit(program.childs, [])
+        program.cacheSize = self.cacheSize
+        return program
+
+
+    def log(self, lineno, linepos, msg):
+        self.report.append('%d:%d: %s' % (lineno, linepos, msg))
+
+
+    # Optimize a list of statements. loops holds the effects of
+    # the enclosing loops, outermost first
+    def visit(self, stmts, loops):
+        for stmt in stmts:
+            if isinstance(stmt, AssignNode):
+                self.rval(stmt.childs[1], loops)
+            elif isinstance(stmt, MethodCallNode):
+                for arg in stmt.childs[2]:
+                    self.rval(arg, loops)
+            elif isinstance(stmt, PrintNode):
+                for arg in stmt.childs:
+                    self.rval(arg, loops)
+            elif isinstance(stmt, ForNode):
+                stmt.hoisted = []
+                self.visit(stmt.childs[2:],
+                           loops + [LoopEffects(stmt)])
+            elif isinstance(stmt, IfNode):
+                stmt.childs[0] = self.cond(stmt.childs[0], loops)
+                self.visit(stmt.childs[1], loops)
+                if stmt.childs[2] is not None:
+                    self.visit(stmt.childs[2], loops)
+
+
+    def rval(self, rvalNode, loops):
+        v = self.fold(rvalNode.childs[0])
+        rvalNode.childs[0] = self.hoist(v, loops)
+
+
+    # Fold the constant operations of an expression
+    def fold(self, v):
+        if not isinstance(v, ExpNode):
+            return v
+        v1 = v.childs[0] = self.fold(v.childs[0])
+        v2 = v.childs[1] = self.fold(v.childs[1])
+        if not (_isNumber(v1) and type(v1) is type(v2)):
+            # Type errors are left to the execution
+            return v
+        try:
+            retVal = v.childs[2](v1, v2)
+        except ZeroDivisionError:
+            return v
+        if type(retVal) is not type(v1):
+            return v
+        self.log(v.childs[3], v.childs[4], 'folded [%s] into [%s]' % \
+                     (_exprStr(v), retVal))
+        return retVal
+
+
+    # Cache the largest loop-invariant parts of an expression
+    def hoist(self, v, loops):
+        if _isConst(v) or not loops:
+            return v
+        if isinstance(v, ExpNode):
+            lineno, linepos = v.childs[3:5]
+        elif isinstance(v, VarNode) and \
+                (v.childs[1] is not None or v.childs[2] is not None):
+            lineno, linepos = v.lineno, v.linepos
+        else:
+            # Plain variables are already a single lookup
+            return v
+
+        for loop in loops:
+            if loop.isInvariant(v):
+                index = self.cacheSize
+                self.cacheSize += 1
+                loop.forNode.hoisted.append(index)
+                self.log(lineno, linepos,
+                         'hoisted [%s] out of the loop on line %d' % \
+                             (_exprStr(v), loop.forNode.lineno))
+                return CachedNode(lineno, linepos, [v, index])
+
+        if isinstance(v, ExpNode):
+            v.childs[0] = self.hoist(v.childs[0], loops)
+            v.childs[1] = self.hoist(v.childs[1], loops)
+        return v
+
+
+    # Fold constant conditions, and optimize their operands
+    def cond(self, c, loops):
+        v1, v2, op = c.childs
+        if op is None:
+            return c
+        elif v2 is None:
+            v1 = c.childs[0] = self.cond(v1, loops)
+            if v1.childs[2] is None:
+                return self.constCond(c, op(v1.childs[0]))
+        elif isinstance(v1, CondNode):
+            v1 = c.childs[0] = self.cond(v1, loops)
+            v2 = c.childs[1] = self.cond(v2, loops)
+            if v1.childs[2] is None and v2.childs[2] is None:
+                return self.constCond(c, op(v1.childs[0],
+                                            v2.childs[0]))
+        else:
+            self.rval(v1, loops)
+            self.rval(v2, loops)
+            if _isConst(v1.childs[0]) and _isConst(v2.childs[0]):
+                return self.constCond(c, op(v1.childs[0],
+                                            v2.childs[0]))
+        return c
+
+
+    def constCond(self, c, value):
+        self.log(c.lineno, c.linepos,
+                 'folded condition into [%s]' % bool(value))
+        return CondNode(c.lineno, c.linepos,
+                        [bool(value), None, None])
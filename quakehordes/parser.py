@@ -5,11 +5,15 @@
 #*************************************************
 import types
 import logging
+import copy
+import threading
+from os import getpid, path
 from ply import yacc as yacc
 
 # Get the tokens from the lexer
 from lexer import tokens
 from parser_internals import *
+from cache import GetCacheDir, HashContent, CommitFile
 
 
 class QHDLSyntaxError(Exception):
@@ -27,10 +31,6 @@ class QHDLSyntaxError(Exception):
              self.token.type, self.token.value)
 
 
-# Global variables
-ENV = Env()
-
-
 # Return the column position for symbol p
 def _retRuleLinepos(p, i):
     # fix for the parsing of the first line of code
@@ -256,8 +256,17 @@ def p_for_stmt_start(p):
 
 
 def p_range(p):
-    '''range : O_ROUND INT_VAL COMMA INT_VAL C_ROUND'''
-    p[0] = range(p[2], p[4])
+    '''range : O_ROUND INT_VAL COMMA INT_VAL C_ROUND
+             | O_ROUND INT_VAL COMMA INT_VAL COMMA INT_VAL C_ROUND'''
+    if len(p) == 6:
+        childs = [p[2], p[4], 1]
+        p[0] = RangeNode(p.lineno(2), _retRuleLinepos(p, 2),
+                         childs)
+    else:
+        # The step position is the one reported on errors
+        childs = [p[2], p[4], p[6]]
+        p[0] = RangeNode(p.lineno(6), _retRuleLinepos(p, 6),
+                         childs)
 
 
 def p_if_stmt(p):
@@ -360,9 +369,66 @@ def p_error(t):
 # Grammar productions definition end
 #************************************
 
-# Build the parser
-def BuildQHDLParser(workDir):
-    # WARNING: reenable logging if problems occur
-    #return yacc.yacc(outputdir=workDir)
-    return yacc.yacc(outputdir=workDir,
-                     errorlog=yacc.NullLogger())
+# Signature of the grammar: hash of the productions and of the
+# tokens, used as key for the tables cache
+def _grammarSignature():
+    rules = [func for name, func in globals().items()
+             if name.startswith('p_') and
+             type(func) is types.FunctionType]
+    rules.sort(key=lambda func: func.func_code.co_firstlineno)
+    chunks = [yacc.__tabversion__, repr(tokens), repr(precedence)]
+    for func in rules:
+        chunks.append(func.__name__)
+        chunks.append(func.__doc__ or '')
+    return HashContent(*chunks)
+
+
+# Load the tables from the user cache, generating and publishing
+# them if they are not available yet
+def _loadQHDLParser(signature):
+    tabName = 'parsetab_%s' % signature
+    cacheDir = GetCacheDir('parser')
+    tabFile = path.join(cacheDir, tabName+'.py')
+
+    if path.exists(tabFile):
+        # Load the tables without writing anything in the cache
+        # (no .pyc file), since other processes may read it
+        tabModule = types.ModuleType(tabName)
+        tabModule.__file__ = tabFile
+        with open(tabFile, 'r') as f:
+            exec f.read() in tabModule.__dict__
+        return yacc.yacc(tabmodule=tabModule, debug=False,
+                         write_tables=False,
+                         errorlog=yacc.NullLogger())
+
+    # Generate the tables on a private file and then publish it
+    tmpName = '%s_%d' % (tabName, getpid())
+    parser = yacc.yacc(tabmodule=tmpName, outputdir=cacheDir,
+                       debug=False,
+                       errorlog=yacc.NullLogger())
+    tmpFile = path.join(cacheDir, tmpName+'.py')
+    if path.exists(tmpFile):
+        CommitFile(tmpFile, tabFile)
+    return parser
+
+
+GRAMMAR_SIGNATURE = _grammarSignature()
+
+# Parsers built so far by this process, keyed by grammar signature
+_PARSERS = {}
+_PARSERS_LOCK = threading.Lock()
+
+
+# Build the parser. Tables are generated once and cached in the
+# user cache directory (see cache.py), so workDir is no longer
+# used and is kept only for backward compatibility
+def BuildQHDLParser(workDir=None):
+    with _PARSERS_LOCK:
+        try:
+            parser = _PARSERS[GRAMMAR_SIGNATURE]
+        except KeyError:
+            parser = _loadQHDLParser(GRAMMAR_SIGNATURE)
+            _PARSERS[GRAMMAR_SIGNATURE] = parser
+    # Parsers keep their parsing stacks as attributes: return a
+    # private parser sharing the read-only tables
+    return copy.copy(parser)
@@ -39,7 +39,8 @@ METHODS = {'add':getattr(list, 'append'),
            'remove':getattr(list, 'remove')}
 
 
-# Symbol class
+# Symbol class, holding the value of a global variable once the
+# program has been executed
 class Symbol(object):
 
     def __init__(self, _id, _type, value, dim=None):
@@ -49,59 +50,158 @@ class Symbol(object):
         self.value = value
 
 
-# Class used for implement scopes
+# Base class of the records implementing the defined types. Each
+# type has its own record class, with one slot for each field and
+# the fields types shared at class level. New records are cloned
+# from the prototype of the type (see RECORDS)
+class Record(object):
+
+    __slots__ = ()
+
+    # Defined type, fields types and fields holding a list (set
+    # on each record class)
+    TYPE = None
+    FIELDS = {}
+    LISTS = ()
+
+    def clone(self):
+        cls = self.__class__
+        rec = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(rec, field, getattr(self, field))
+        # Lists are never shared between records
+        for field in cls.LISTS:
+            setattr(rec, field, [])
+        return rec
+
+
+# Default values of the fields of a new variable
+def _fieldDefault(_type):
+    if _type.endswith('[]'):
+        return []
+    elif _type == 'int':
+        return 0
+    elif _type == 'real':
+        return 0.0
+    elif _type == 'string':
+        return ''
+    return None
+
+
+# Build the record class of each defined type and return their
+# prototypes
+def _buildRecords():
+    records = {}
+    for _type, fields in TYPES.items():
+        lists = [field for field, fieldType in fields.items()
+                 if fieldType.endswith('[]')]
+        cls = type(_type+'Record', (Record,),
+                   {'__slots__':tuple(sorted(fields)),
+                    'TYPE':_type,
+                    'FIELDS':fields,
+                    'LISTS':tuple(sorted(lists))})
+        proto = cls.__new__(cls)
+        for field, fieldType in fields.items():
+            setattr(proto, field, _fieldDefault(fieldType))
+        records[_type] = proto
+    return records
+
+RECORDS = _buildRecords()
+
+
+# Placeholder of the cached values not computed yet
+NOT_CACHED = object()
+
+
+# Execution environment. Variables live in preallocated frames,
+# one for each block nesting depth, and are accessed through the
+# (depth, slot) addresses computed by the Resolver. Once the
+# program has been executed, global variables are also available
+# by name. The cache holds the values of the expressions hoisted
+# out of loops (see optimizer)
 class Env(object):
 
-    def __init__(self):
+    def __init__(self, frameSizes=(0,), cacheSize=0):
+        self.frames = [[None]*size for size in frameSizes]
         self.globalScope = {}
-        self.currScope = self.globalScope
-        self.scopes = []
-        self.scopes.append(self.globalScope)
-
-
-    def push(self, obj=None):
-        if obj is not None:
-            self.scopes.append(obj)
-        else:
-            self.scopes.append({})
-        self.currScope = self.scopes[-1]
-        
-
-    def pop(self):
-        if self.currScope is self.globalScope:
-            return self.globalScope
-        self.currScope = self.scopes[-2]
-        return self.scopes.pop()
-
+        self.cache = [NOT_CACHED]*cacheSize
 
-    def add(self, name, obj):
-        self.currScope[name] = obj
-
-    
-    def get(self, name):
-        return self.currScope[name]
 
+# Static resolver, run on the AST after parsing. It gives each
+# declared variable a (depth, slot) address, where depth is the
+# nesting level of the block (0 for the program, +1 for each for
+# and if block) and slot its position in the block frame. Blocks
+# at the same depth are never active together, so they share the
+# same frame. Types are static, so the resolver also records the
+# type of each variable
+class Resolver(object):
 
-    def set(self, name, value):
-        self.currScope[name] = value
+    def __init__(self):
+        # Names declared on each active block, with their
+        # address and type, and number of slots used by each
+        # block
+        self.blocks = []
+        self.slots = []
+        # Frame size required for each depth
+        self.frameSizes = []
+        # Global variables (name, type, dim, slot)
+        self.globals = []
+
+
+    def resolve(self, program):
+        self.push()
+        for stmt in program.childs:
+            stmt.resolve(self)
+        self.pop()
+        program.frameSizes = self.frameSizes
+        program.globals = self.globals
+        return program
+
+
+    def push(self):
+        self.blocks.append({})
+        self.slots.append(0)
+        if len(self.frameSizes) < len(self.blocks):
+            self.frameSizes.append(0)
 
 
-    def search(self, name): 
-        i = len(self.scopes)-1
-        while i >= 0:
-            tmp = self.scopes[i]
+    def pop(self):
+        self.blocks.pop()
+        self.slots.pop()
+
+
+    # Declare a name on the current block. Return its address, or
+    # None if the name is already declared on this block
+    def declare(self, name, _type, dim=None):
+        block = self.blocks[-1]
+        if name in block:
+            return None
+        addr = self.newSlot()
+        block[name] = (addr, _type)
+        if addr[0] == 0:
+            self.globals.append((name, _type, dim, addr[1]))
+        return addr
+
+
+    # Reserve a slot on the current block frame
+    def newSlot(self):
+        depth = len(self.blocks)-1
+        slot = self.slots[depth]
+        self.slots[depth] += 1
+        if self.frameSizes[depth] <= slot:
+            self.frameSizes[depth] = slot+1
+        return (depth, slot)
+
+
+    # Return the address and the type of a visible name, None
+    # for both if undeclared
+    def search(self, name):
+        for block in reversed(self.blocks):
             try:
-                return tmp[name]
+                return block[name]
             except KeyError:
-                i-=1
-                continue
-        raise KeyError(name)
-
-
-    # TODO: remove?
-    def restore(self, scope):
-        while self.currScope != scope:
-            self.pop()
+                pass
+        return (None, None)
 
 
 # Exceptions raised for execution errors
@@ -125,19 +225,23 @@ class QHDLTypeError(Exception):
 class QHDLValueError(Exception):
 
     def __init__(self, name, lineno, linepos,
-                 argNotInList=False, divByZero=False):
+                 argNotInList=False, divByZero=False,
+                 zeroStep=False):
         super(QHDLValueError, self).__init__()
         self.name = name
         self.lineno = lineno
         self.linepos = linepos
         self.argNotInList = argNotInList
         self.divByZero = divByZero
+        self.zeroStep = zeroStep
 
     def __str__(self):
         if self.argNotInList:
             reason = "argument not in list"
         elif self.divByZero:
             reason = "division by zero"
+        elif self.zeroStep:
+            reason = "range step must not be zero"
         else:
             reason = ""
         return "Invalid value on %d:%d: %s" % \
@@ -200,7 +304,95 @@ class QHDLNameError(Exception):
             (self.lineno, self.name)
 
 
-# Abstract Syntax Tree nodes definition
+# Static type of a constant value
+def _constType(value):
+    if type(value) is int:
+        return 'int'
+    elif type(value) is float:
+        return 'real'
+    return 'string'
+
+
+# Static type of the value of an expression. None if its
+# evaluation always fails
+def _typeOf(v):
+    if isinstance(v, AstNode):
+        return v.valueType()
+    return _constType(v)
+
+
+# Name of the value of an expression, reported by value errors
+def _nameOf(v):
+    if isinstance(v, VarNode):
+        return v.lastName()
+    return 'tmp'
+
+
+# Lookups of a variable chain. Each one is a (get, check, key,
+# isAttr) tuple: get returns the looked up value, check only
+# validates the lookup (for assignments)
+def _itemLookup(_type, offset, lineno, linepos):
+    if _type is not None and _type.endswith('[]'):
+        def getItem(val):
+            try:
+                return val[offset]
+            except IndexError:
+                raise QHDLIndexError(offset, lineno, linepos)
+
+        def checkItem(val):
+            if offset >= len(val):
+                raise QHDLIndexError(offset, lineno, linepos)
+        return (getItem, checkItem, offset, False), _type[:-2]
+
+    # Not a list
+    def invalidItem(val):
+        raise QHDLIndexError(offset, lineno, linepos)
+    return (invalidItem, invalidItem, offset, False), None
+
+
+def _attrLookup(_type, attrName, lineno, linepos):
+    if _type in TYPES and attrName in TYPES[_type]:
+        def getAttr(val):
+            try:
+                return getattr(val, attrName)
+            except AttributeError:
+                # Unset variable (e.g. the next Map)
+                raise QHDLAttrError(_type, attrName,
+                                    lineno, linepos)
+
+        def checkAttr(val):
+            if val is None:
+                raise QHDLAttrError(_type, attrName,
+                                    lineno, linepos)
+        return (getAttr, checkAttr, attrName, True), \
+            TYPES[_type][attrName]
+
+    # No such field, or not a variable (e.g. a list)
+    def invalidAttr(val):
+        raise QHDLAttrError(_type, attrName, lineno, linepos)
+    return (invalidAttr, invalidAttr, attrName, True), None
+
+
+# Compile a list of statements as a single function
+def _compileBlock(stmts):
+    code = tuple([stmt.compile() for stmt in stmts])
+    if len(code) == 1:
+        return code[0]
+
+    def block(scope):
+        for stmt in code:
+            stmt(scope)
+    return block
+
+
+# Abstract Syntax Tree nodes definition. Instead of being walked
+# at each execution, the tree is resolved (see Resolver) and then
+# compiled once into a tree of python closures: each compile()
+# returns a function that takes the execution environment.
+# Statements return nothing, values are returned as they are
+# (records, lists and python values), conditions as booleans.
+# Types are static: the type errors are found while compiling,
+# but they are raised when the faulty code is executed
 class AstNode(object):
 
     def __init__(self, lineno, linepos, childs=None):
@@ -211,373 +403,559 @@ class AstNode(object):
         else:
             self.childs = []
 
-    def action(self, scope):
+    def resolve(self, resolver):
         for child in self.childs:
-            child.action(scope)
+            if isinstance(child, AstNode):
+                child.resolve(resolver)
+
+    def compile(self):
+        return _compileBlock(self.childs)
+
+    def valueType(self):
+        return None
 
 
 class ProgramNode(AstNode):
-    pass
+
+    # Number of cached expressions, set by the optimizer
+    cacheSize = 0
+    # Global variables, set by the resolver
+    globals = ()
+
+    def compile(self):
+        code = _compileBlock(self.childs)
+        globalVars = tuple(self.globals)
+
+        def program(scope):
+            code(scope)
+            # Publish the global variables
+            frame = scope.frames[0]
+            for name, _type, dim, slot in globalVars:
+                scope.globalScope[name] = Symbol(name, _type,
+                                                 frame[slot], dim)
+        return program
 
 
 class DeclNode(AstNode):
-    
-    def action(self, scope):
+
+    def resolve(self, resolver):
         _type = self.childs[0]
-        name = self.childs[1]
-        
-        # Search for already declared variables
-        try:
-            scope.get(name)
-            raise QHDLNameError(name, self.lineno,
-                               self.linepos, True)
-        except KeyError:
-            pass
+        if self.childs[2] is not None:
+            _type += '[]'
+        # A None address marks an already declared variable
+        self.addr = resolver.declare(self.childs[1], _type,
+                                     self.childs[2])
 
+    
+    def compile(self):
+        name = self.childs[1]
         dim = self.childs[2]
-        if dim is None:
-            # Single-dimension variable declaration
-            value = {}
-            value.update(TYPES[_type])
-            sym = Symbol(name, _type, value, dim)
-            # Init fields
-            for field,_type in sym.value.items():
-                tmp = Symbol(field, _type, None)
-                # Array field: init as an empty list
-                if _type.endswith('[]'):
-                    tmp.value = []
-                # Other types: init as empty-value variable
-                elif _type == 'int':
-                    tmp.value = 0
-                elif _type == 'real':
-                    tmp.value = 0.0
-                elif _type == 'string':
-                    tmp.value = ''
-                sym.value[field]=tmp
-        else:
+        lineno = self.lineno
+        linepos = self.linepos
+
+        if self.addr is None:
+            def redecl(scope):
+                raise QHDLNameError(name, lineno, linepos, True)
+            return redecl
+        depth, slot = self.addr
+
+        if dim is not None:
             # List declaration
-            value = []
-            _type += '[]'
-            sym = Symbol(name, _type, value, dim)
+            def declList(scope):
+                scope.frames[depth][slot] = []
+            return declList
 
-        scope.add(name, sym)
-        return sym
+        # Single-dimension variable declaration
+        clone = RECORDS[self.childs[0]].clone
+        def decl(scope):
+            scope.frames[depth][slot] = clone()
+        return decl
 
 
 class AssignNode(AstNode):
     
-    def action(self, scope):
+    def compile(self):
         lvalNode = self.childs[0]
         rvalNode = self.childs[1]
-        lval = lvalNode.action(scope)
-        rval = rvalNode.action(scope)
-
-        # Assignment as simple symbol-value copy
-        if lval.type == rval.type:
-            lval.value = rval.value
-        else:
-            raise QHDLTypeError(rval.type, lval.type,
-                               rvalNode.lineno,
-                               rvalNode.linepos)
+        getTarget, key, isAttr = lvalNode.compileTarget()
+        getRval = rvalNode.compile()
+        lvalType = lvalNode.valueType()
+        rvalType = rvalNode.valueType()
+        lineno = rvalNode.lineno
+        linepos = rvalNode.linepos
+
+        if lvalType != rvalType:
+            def invalidAssign(scope):
+                getTarget(scope)
+                getRval(scope)
+                raise QHDLTypeError(rvalType, lvalType,
+                                    lineno, linepos)
+            return invalidAssign
+
+        # Assignment as simple value copy
+        if isAttr:
+            def assignAttr(scope):
+                target = getTarget(scope)
+                setattr(target, key, getRval(scope))
+            return assignAttr
+
+        def assign(scope):
+            target = getTarget(scope)
+            target[key] = getRval(scope)
+        return assign
 
 
 class LvalNode(AstNode):
 
-    def action(self, scope):
-        varNode = self.childs[0]
-        var = varNode.action(scope)
-        val = var
-        return val
+    def compile(self):
+        return self.childs[0].compile()
+
+
+    def compileTarget(self):
+        return self.childs[0].compileTarget()
+
+
+    def valueType(self):
+        return self.childs[0].valueType()
 
 
 class RvalNode(AstNode):
 
-    def action(self, scope):
-        try:
-            varNode = self.childs[0]
-            var = varNode.action(scope)
-            val = var
-
-        except (TypeError, AttributeError):
-            # TODO: how to (and where) handle types?
-            value = self.childs[0]
-            if type(value) is int:
-                _type = 'int'
-            elif type(value) is float:
-                _type = 'real'
-            else:
-                _type = 'string'
+    def compile(self):
+        value = self.childs[0]
+        if isinstance(value, AstNode):
+            return value.compile()
 
-            val = Symbol("tmp", _type, value)
-        
-        return val
+        def const(scope):
+            return value
+        return const
 
 
-class VarNode(AstNode):
+    def valueType(self):
+        return _typeOf(self.childs[0])
 
-    def action(self, scope):
-        varName = self.childs[0]
-        varOffset = self.childs[1]
-        try:
-            val = scope.search(varName)
-        except KeyError, e:
-            raise QHDLNameError(varName, 
-                               self.lineno,
-                               self.linepos)
 
-        if varOffset is not None:
-            try:
-                if varOffset >= 0:
-                    val = val.value[varOffset]
-                else:
-                    raise IndexError()
-            except IndexError, e:
-                raise QHDLIndexError(varOffset,
-                                    self.lineno,
-                                    self.linepos+len(varName)+1)
-
-        # Perform attribute lookup
-        if self.childs[2] is not None:
-            scope.push(val.value)
-            attr = self.childs[2]
-            try:
-                val = attr.action(scope)
-            except KeyError, e:
-                raise QHDLAttrError(val.type,
-                                   attr.childs[0],
-                                   attr.lineno,
-                                   attr.linepos)
-            scope.pop()
+class VarNode(AstNode):
 
-        return val
+    def resolve(self, resolver):
+        self.addr, self.varType = \
+            resolver.search(self.childs[0])
 
 
+    # Return the lookups of the chain and the type of its value
+    def _lookups(self):
+        varName = self.childs[0]
+        lookups = []
+        _type = self.varType
+        if self.childs[1] is not None:
+            lookup, _type = _itemLookup(
+                _type, self.childs[1], self.lineno,
+                self.linepos+len(varName)+1)
+            lookups.append(lookup)
+
+        attr = self.childs[2]
+        while attr is not None and _type is not None:
+            attrName = attr.childs[0]
+            lookup, _type = _attrLookup(_type, attrName,
+                                        attr.lineno, attr.linepos)
+            lookups.append(lookup)
+            if attr.childs[1] is not None and _type is not None:
+                lookup, _type = _itemLookup(
+                    _type, attr.childs[1], attr.lineno,
+                    attr.linepos+len(attrName)+1)
+                lookups.append(lookup)
+            attr = attr.childs[2]
+        return lookups, _type
+
+
+    def valueType(self):
+        if self.addr is None:
+            return None
+        return self._lookups()[1]
+
+
+    def lastName(self):
+        name = self.childs[0]
+        attr = self.childs[2]
+        while attr is not None:
+            name = attr.childs[0]
+            attr = attr.childs[2]
+        return name
+
+
+    def _undeclared(self):
+        varName = self.childs[0]
+        lineno = self.lineno
+        linepos = self.linepos
+        def undeclared(scope):
+            raise QHDLNameError(varName, lineno, linepos)
+        return undeclared
+
+
+    def compile(self):
+        if self.addr is None:
+            return self._undeclared()
+        depth, slot = self.addr
+        getters = tuple([get for get, check, key, isAttr
+                         in self._lookups()[0]])
+
+        # Specialized lookups for the most common chains
+        if not getters:
+            def var(scope):
+                return scope.frames[depth][slot]
+            return var
+
+        if len(getters) == 1:
+            get = getters[0]
+            def varLookup(scope):
+                return get(scope.frames[depth][slot])
+            return varLookup
+
+        def varChain(scope):
+            val = scope.frames[depth][slot]
+            for get in getters:
+                val = get(val)
+            return val
+        return varChain
+
+
+    # Compile the variable as an assignment target. Return the
+    # function retrieving the object holding the value (a
+    # frame, a record or a list), and the key of the value
+    def compileTarget(self):
+        if self.addr is None:
+            return self._undeclared(), None, False
+        depth, slot = self.addr
+        lookups = self._lookups()[0]
+
+        if not lookups:
+            def frame(scope):
+                return scope.frames[depth]
+            return frame, slot, False
+
+        getters = tuple([get for get, check, key, isAttr
+                         in lookups[:-1]])
+        get, check, key, isAttr = lookups[-1]
+        if not getters:
+            def varTarget(scope):
+                val = scope.frames[depth][slot]
+                check(val)
+                return val
+            return varTarget, key, isAttr
+
+        def target(scope):
+            val = scope.frames[depth][slot]
+            for get in getters:
+                val = get(val)
+            check(val)
+            return val
+        return target, key, isAttr
+
+
+# Attribute lookups are compiled together with their variable
+# (see VarNode)
 class AttrNode(AstNode):
+    pass
 
-    def action(self, scope):
-        attrName = self.childs[0]
-        attrOffset = self.childs[1]
-        # Get attrName symbol from current scope
-        val = scope.get(attrName)
-        if attrOffset is not None:
-            try:
-                if attrOffset >= 0:
-                    val = val.value[attrOffset]
-                else:
-                    raise IndexError()
-            except IndexError, e:
-                raise QHDLIndexError(attrOffset,
-                                    self.lineno,
-                                    self.linepos+len(attrName)+1)
 
-        if self.childs[2] is not None:
-            # Perform next attribute lookup
-            scope.push(val.value)
-            attr = self.childs[2]
-            try:
-                val = attr.action(scope)
-            except KeyError, e:
-                raise QHDLAttrError(val.type,
-                                   attr.childs[0],
-                                   attr.lineno,
-                                   attr.linepos)
-            # Restore the scope
-            scope.pop()
-        
-        return val
+class MethodCallNode(AstNode):
 
+    def resolve(self, resolver):
+        self.childs[1][0].resolve(resolver)
+        for arg in self.childs[2]:
+            arg.resolve(resolver)
 
-class MethodCallNode(AstNode):
 
-    def action(self, scope):
+    def compile(self):
         methName = self.childs[0]
         methVar = self.childs[1][0]
         methArgs = self.childs[2]
-        # Retrieve the variable symbol
-        var = methVar.action(scope)
+        lineno = methVar.lineno
+        # Retrieve the variable
+        getVar = methVar.compile()
+        varType = methVar.valueType()
+
         # Retrieve the function
         try:
             method = METHODS[methName]
-        except KeyError, e:
-            methodLinepos = self.childs[1][-1].linepos + \
-                len(var.id) + 1
-            raise QHDLAttrError(var.type, methName,
-                               methVar.lineno,
-                               #methVar.linepos,
-                               methodLinepos,
-                               True)
-        # Retrive the args
-        #args = [attr[0].action(scope) for attr in methArgs]
+        except KeyError:
+            linepos = self.childs[1][-1].linepos + \
+                len(methVar.lastName()) + 1
+            def invalidMethod(scope):
+                getVar(scope)
+                raise QHDLAttrError(varType, methName, lineno,
+                                    linepos, True)
+            return invalidMethod
+
         # TODO: perform number-of-arguments checks???
-        #args = []
-        for arg in methArgs:
-            argSym = arg.action(scope)
-            if argSym.type != var.type[:-2]:
-                raise QHDLTypeError(argSym.type, var.type[:-2],
-                                   arg.lineno, arg.linepos)
-            #args.append(argSym)
-            
-            # and call the method for each arg
-            try:
-                method(var.value, argSym)
-            except ValueError:
-                # Ignore the call if the argument is not in
-                # list for delection calls 
-                raise QHDLValueError(argSym.id,
-                                     arg.lineno,
-                                     arg.linepos, 
-                                     argNotInList=True)
-
-        # Finally, call the method
-        #return method(var.value,
-        #              *[arg for arg in args])
+        itemType = (varType or '')[:-2]
+        args = tuple([(arg.compile(), arg.valueType(),
+                       _nameOf(arg.childs[0]),
+                       arg.lineno, arg.linepos)
+                      for arg in methArgs])
+
+        def methodCall(scope):
+            var = getVar(scope)
+            for getArg, argType, argName, argLineno, \
+                    argLinepos in args:
+                arg = getArg(scope)
+                if argType != itemType:
+                    raise QHDLTypeError(argType, itemType,
+                                        argLineno, argLinepos)
+                # and call the method for each arg
+                try:
+                    method(var, arg)
+                except ValueError:
+                    raise QHDLValueError(argName, argLineno,
+                                         argLinepos,
+                                         argNotInList=True)
+        return methodCall
     
 
 class PrintNode(AstNode):
 
-    def action(self, scope):
-        args = self.childs
-        syms = [val.action(scope) for val in args]
-        outStr = ''.join([str(sym.value)+' '
-                          for sym in syms])[:-1]
+    def compile(self):
+        args = tuple([arg.compile() for arg in self.childs])
 
-        print outStr
+        def _print(scope):
+            print ' '.join([str(getArg(scope)) for getArg in args])
+        return _print
 
 
 class ForNode(AstNode):
 
-    def action(self, scope):
-        try:
-            # List iterator
-            var = self.childs[0].action(scope)
+    # Cache entries of the expressions hoisted out of the loop,
+    # set by the optimizer
+    hoisted = ()
+
+    def resolve(self, resolver):
+        # The iterator is evaluated in the enclosing block, the
+        # loop variable lives in the block of the loop body
+        if isinstance(self.childs[0], AstNode):
+            self.childs[0].resolve(resolver)
             symName = self.childs[1]
-            symType = var.type[:-2]
-            it = [s.value for s in var.value]
+            symType = self.childs[0].valueType()
+            if symType is not None and symType.endswith('[]'):
+                symType = symType[:-2]
+            else:
+                symType = None
+        else:
+            symName = self.childs[0]
+            symType = 'int'
+        resolver.push()
+        self.addr = resolver.declare(symName, symType)
+        for stmt in self.childs[2:]:
+            stmt.resolve(resolver)
+        resolver.pop()
 
-        except AttributeError:
+
+    def compile(self):
+        code = _compileBlock(self.childs[2:])
+        depth, slot = self.addr
+        hoisted = tuple(self.hoisted)
+
+        if not isinstance(self.childs[0], AstNode):
             # Integers iterator
-            it = self.childs[1]
-            symName = self.childs[0]
-            symType = "int"
-        
-        code = self.childs[2:]
-        # For each item in the iterator ...
-        for i in it:
-            # ... create a new scope ...
-            scope.push({})
-            # ... push the i-th item in the current scope
-            sym = Symbol(symName, symType, None)
-            sym.value = i
-            scope.set(symName, sym)
-            # ... and finally execute the for code-block
-            for child in code:
-                child.action(scope)
-            scope.pop()
+            rangeNode = self.childs[1]
+            start, stop, step = rangeNode.childs
+
+            if step == 0:
+                def invalidLoop(scope):
+                    raise QHDLValueError('step', rangeNode.lineno,
+                                         rangeNode.linepos,
+                                         zeroStep=True)
+                return invalidLoop
+
+            # Integers are generated while looping
+            it = xrange(start, stop, step)
+
+            def intLoop(scope):
+                frame = scope.frames[depth]
+                # Hoisted values are computed again on each run
+                # of the loop
+                for index in hoisted:
+                    scope.cache[index] = NOT_CACHED
+                for i in it:
+                    # Bind the i-th item to the loop variable
+                    frame[slot] = i
+                    code(scope)
+            return intLoop
+
+        # List iterator
+        iterNode = self.childs[0]
+        getVar = iterNode.compile()
+        iterType = iterNode.valueType()
+
+        if iterType is None or not iterType.endswith('[]'):
+            def invalidLoop(scope):
+                getVar(scope)
+                raise QHDLTypeError(iterType, 'list',
+                                    iterNode.lineno,
+                                    iterNode.linepos)
+            return invalidLoop
+
+        def listLoop(scope):
+            it = list(getVar(scope))
+            frame = scope.frames[depth]
+            for index in hoisted:
+                scope.cache[index] = NOT_CACHED
+            # For each item in the iterator ...
+            for i in it:
+                # ... bind the i-th item to the loop variable and
+                # execute the for code-block
+                frame[slot] = i
+                code(scope)
+        return listLoop
+
+
+# Integers range of a for loop: (start, stop, step). Looped over
+# by ForNode
+class RangeNode(AstNode):
+    pass
 
 
 class CondNode(AstNode):
     
-    def action(self, scope):
+    def compile(self):
         v1 = self.childs[0]
         v2 = self.childs[1]
         op = self.childs[2]
-        # Retrieve values
-        val1 = v1.action(scope)
-        # Apply operator on values
-        if v2 is not None:
-            # Binary operator
-            val2 = v2.action(scope)
-            try:
-                retVal = op(val1.value, val2.value)
-            except AttributeError:
-                retVal = op(val1, val2)
-        else:
+
+        if op is None:
+            # Condition folded by the optimizer
+            def constCond(scope):
+                return v1
+            return constCond
+
+        getVal1 = v1.compile()
+
+        if v2 is None:
             # Unary operator
-            try:
-                retVal = op(val1.value)
-            except AttributeError:
-                retVal = op(val1)
+            def unaryCond(scope):
+                return op(getVal1(scope))
+            return unaryCond
 
-        return retVal
+        getVal2 = v2.compile()
+        if isinstance(v1, CondNode):
+            # Logic operator on conditions. Both operands are
+            # always evaluated
+            def logicCond(scope):
+                return op(getVal1(scope), getVal2(scope))
+            return logicCond
+
+        # Comparison between values
+        def compareCond(scope):
+            return op(getVal1(scope), getVal2(scope))
+        return compareCond
 
 
 class ExpNode(AstNode):
     
     TYPES = ['int', 'real']
 
-    def action(self, scope):
+    # Return the function retrieving an operand
+    @staticmethod
+    def _compileOperand(v, lineno, linepos):
+        if isinstance(v, AstNode):
+            return v.compile()
 
-        v1 = self.childs[0]
-        v2 = self.childs[1]
+        if type(v) is int or type(v) is float:
+            def const(scope):
+                return v
+            return const
+
+        # Not a number: fail when evaluated
+        def invalidConst(scope):
+            raise QHDLTypeError(str(type(v)), 'int, float',
+                                lineno, linepos)
+        return invalidConst
+
+
+    def valueType(self):
+        type1 = _typeOf(self.childs[0])
+        if type1 == _typeOf(self.childs[1]) and \
+                type1 in ExpNode.TYPES:
+            return type1
+        return None
+
+
+    def compile(self):
         op = self.childs[2]
         v1pos = self.childs[3:5]
         v2pos = self.childs[5:]
-
-        # Retrieve values
-        try:
-            val1 = v1.action(scope)
-        except AttributeError:
-            if type(v1) is int:
-                _type = 'int'
-            elif type(v1) is float:
-                _type = 'real'
-            else:
-                raise QHDLTypeError(str(type(v1)),
-                                    'int, float',
-                                    v1pos[0], v1pos[1])
-            val1 = Symbol('tmp', _type, v1)
-
-        try:
-            val2 = v2.action(scope)
-        except AttributeError:
-            if type(v2) is int:
-                _type = 'int'
-            elif type(v2) is float:
-                _type = 'real'
-            else:
-                raise QHDLTypeError(str(type(v2)),
-                                    'int, float',
-                                    v2pos[0], v2pos[1])
-            val2 = Symbol('tmp', _type, v2)
-
-        # Apply operator on values
-        if val1.type in ExpNode.TYPES and \
-                val2.type in ExpNode.TYPES and \
-                val1.type == val2.type:
+        getVal1 = ExpNode._compileOperand(self.childs[0], *v1pos)
+        getVal2 = ExpNode._compileOperand(self.childs[1], *v2pos)
+        type1 = _typeOf(self.childs[0])
+        type2 = _typeOf(self.childs[1])
+        name2 = _nameOf(self.childs[1])
+        lineno, linepos = v2pos
+
+        if type1 != type2 or type1 not in ExpNode.TYPES:
+            def invalidExp(scope):
+                getVal1(scope)
+                getVal2(scope)
+                raise QHDLTypeError(type2, type1,
+                                    lineno, linepos)
+            return invalidExp
+
+        def exp(scope):
+            val1 = getVal1(scope)
+            val2 = getVal2(scope)
+            # Apply operator on values
             try:
-                retVal = op(val1.value, val2.value)
+                return op(val1, val2)
             except ZeroDivisionError:
                 # TODO: how to manage zero division error?
-                raise QHDLValueError(val2.id, v2pos[0],
-                                     v2pos[1], 
+                raise QHDLValueError(name2, lineno, linepos,
                                      divByZero=True)
-        else:
-            raise QHDLTypeError(val2.type,
-                                val1.type,
-                                v2pos[0], v2pos[1])
-
-        if type(retVal) is int:
-            _type = 'int'
-        else:
-            _type = 'real'
-        
-        return Symbol('tmp', _type, retVal)
+        return exp
 
 
 class IfNode(AstNode):
 
-    def action(self, scope):
-        cond = self.childs[0]
-        trueBlock = self.childs[1]
-        falseBlock = self.childs[2]
-        if cond.action(scope):
-            scope.push({})
-            for stmt in trueBlock:
-                stmt.action(scope)
-            scope.pop()
+    def resolve(self, resolver):
+        self.childs[0].resolve(resolver)
+        for block in self.childs[1:]:
+            if block is not None:
+                resolver.push()
+                for stmt in block:
+                    stmt.resolve(resolver)
+                resolver.pop()
+
+
+    def compile(self):
+        cond = self.childs[0].compile()
+        trueBlock = _compileBlock(self.childs[1])
+        if self.childs[2] is not None:
+            falseBlock = _compileBlock(self.childs[2])
         else:
-            if falseBlock is not None:
-                scope.push({})
-                for stmt in falseBlock:
-                    stmt.action(scope)
-                scope.pop()
+            falseBlock = None
+
+        def _if(scope):
+            if cond(scope):
+                trueBlock(scope)
+            elif falseBlock is not None:
+                falseBlock(scope)
+        return _if
+
+
+# Expression whose value is computed once for each run of the
+# enclosing loop (see optimizer). The first evaluation happens
+# where the original one did, so errors are raised at the same
+# point
+class CachedNode(AstNode):
+
+    def compile(self):
+        getVal = self.childs[0].compile()
+        index = self.childs[1]
+
+        def cached(scope):
+            val = scope.cache[index]
+            if val is NOT_CACHED:
+                val = scope.cache[index] = getVal(scope)
+            return val
+        return cached
+
+
+    def valueType(self):
+        return _typeOf(self.childs[0])
@@ -0,0 +1,184 @@
+#*************************************************
+# scanner.py
+#
+# Hand-written scanner for the Hordes Definition
+# Language. It produces the same tokens of the PLY
+# lexer defined in lexer.py, but reads the sources
+# through mmap and classifies identifiers with a
+# single hash lookup
+#*************************************************
+import re
+import mmap
+
+from lexer import QHDLLexError, reserved, types
+
+
+# Identifiers classification: keywords and type names
+IDENTS = dict(reserved)
+IDENTS.update([(t, 'TYPE') for t in types])
+
+# Operators and punctuation
+OPERATORS = {'==':'EQ', '!=':'NEQ', '>=':'GET', '<=':'LET',
+             '.':'DOT', ':':'COLON', ';':'SEMICOLON',
+             ',':'COMMA', '=':'EQUAL', '>':'GT', '<':'LT',
+             '(':'O_ROUND', ')':'C_ROUND',
+             '[':'O_SQUARE', ']':'C_SQUARE',
+             '+':'ADD', '-':'SUB', '*':'MULT', '/':'DIV'}
+
+# Master regex. Each match skips the blanks before a token.
+# Alternatives follow the PLY rules priority: identifiers and
+# numbers first, then the longest operators
+(_ID, _REAL_VAL, _INT_VAL, _OPERATOR, _NEWLINE,
+ _QUOTED_STRING, _COMMENT) = range(1, 8)
+_MASTER = re.compile(r'''[ ]*(?:
+    ([A-Za-z][A-Za-z0-9_-]*)
+  | ([0-9]*\.[0-9]+)
+  | ([0-9]+)
+  | (==|!=|>=|<=|[.:;,=><()\[\]+\-*/])
+  | (\r*\n+)
+  | ("[^"]*")
+  | (\#[^\n]*)
+)''', re.VERBOSE)
+
+
+class Token(object):
+
+    __slots__ = ('type', 'value', 'lineno', 'lexpos', 'lexer')
+
+    def __init__(self, _type, value, lineno, lexpos):
+        self.type = _type
+        self.value = value
+        self.lineno = lineno
+        self.lexpos = lexpos
+
+
+    def __repr__(self):
+        return 'Token(%s,%r,%d,%d)' % \
+            (self.type, self.value, self.lineno, self.lexpos)
+
+
+# Lexer interface used by the PLY parser (input() and token(),
+# plus the lineno and startLinePos attributes read by the
+# grammar rules)
+class QHDLScanner(object):
+
+    def __init__(self):
+        self.lexdata = ''
+        self.lexpos = 0
+        self.lexlen = 0
+        self.lineno = 1
+        self.startLinePos = -1
+        self._file = None
+        self._map = None
+
+
+    def input(self, data):
+        self.close()
+        self.lexdata = data
+        self.lexpos = 0
+        self.lexlen = len(data)
+        self.lineno = 1
+        self.startLinePos = -1
+        # The scanning state lives in the generator frame:
+        # token() just resumes it
+        self.token = self._scan(data).next
+
+
+    # Scan a file without loading it in memory
+    def inputFile(self, fileName):
+        f = open(fileName, 'rb')
+        try:
+            data = mmap.mmap(f.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # Empty files (and special files) can't be mapped
+            data = f.read()
+            f.close()
+            self.input(data)
+            return
+        self.input(data)
+        self._file = f
+        self._map = data
+
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self.lexdata = ''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    def token(self):
+        # No input given yet
+        return None
+
+
+    def _scan(self, data):
+        match = _MASTER.scanner(data).match
+        idents = IDENTS.get
+        operators = OPERATORS
+        lineno = self.lineno
+        m = None
+        while True:
+            last = m
+            m = match()
+            if m is None:
+                break
+            group = m.lastindex
+            if group == _ID:
+                value = m.group(_ID)
+                yield Token(idents(value, 'ID'), value,
+                            lineno, m.start(_ID))
+            elif group == _OPERATOR:
+                value = m.group(_OPERATOR)
+                yield Token(operators[value], value,
+                            lineno, m.start(_OPERATOR))
+            elif group == _NEWLINE:
+                start, end = m.span(_NEWLINE)
+                lineno += end-start
+                self.lineno = lineno
+                self.startLinePos = start
+                self.lexpos = end
+            elif group == _INT_VAL:
+                yield Token('INT_VAL', int(m.group(_INT_VAL)),
+                            lineno, m.start(_INT_VAL))
+            elif group == _REAL_VAL:
+                yield Token('REAL_VAL',
+                            float(m.group(_REAL_VAL)),
+                            lineno, m.start(_REAL_VAL))
+            elif group == _QUOTED_STRING:
+                yield Token('QUOTED_STRING',
+                            m.group(_QUOTED_STRING)[1:-1],
+                            lineno, m.start(_QUOTED_STRING))
+            # Comments are skipped
+
+        # No more tokens: skip the trailing blanks and check for
+        # unexpected characters
+        if last is not None:
+            pos = last.end()
+        else:
+            pos = 0
+        while pos < self.lexlen and data[pos] == ' ':
+            pos += 1
+        self.lexpos = pos
+        if pos < self.lexlen:
+            raise QHDLLexError(Token('error', data[pos],
+                                     lineno, pos),
+                               lineno, pos-self.startLinePos-1)
+        while True:
+            yield None
+
+
+    # Iterator interface, as for the PLY lexer
+    def __iter__(self):
+        return self
+
+
+    def next(self):
+        tok = self.token()
+        if tok is None:
+            raise StopIteration
+        return tok
@@ -0,0 +1,147 @@
+#*************************************************
+# test_bsp.py
+#
+# Tests of the .bsp entities patching. Run them with
+#   python -m unittest discover tests
+#*************************************************
+import os
+import struct
+import unittest
+from tempfile import mkstemp
+
+from quakehordes.bsp import ParseMap, MapGeometry, EntityLump, \
+    PatchEntityLump, BSP_HEADER
+
+
+MAP_CODE = '''// Map test
+{
+"classname" "worldspawn"
+{
+( 16 16 16 ) ( 16 0 16 ) ( 0 16 16 ) tile2 0 0 0 16 16
+}
+}
+{
+"classname" "func_door"
+"message" "Two
+lines { }"
+{
+( 8 8 8 ) ( 8 0 8 ) ( 0 8 8 ) metal1 0 0 0 4 8
+}
+}
+{
+"classname" "light_flame_large_yellow"
+"light" 2
+"origin" "10 10 10"
+}
+'''
+
+
+# Write a .bsp file holding the entities lump and another lump
+# (before or after it). Return the file name
+def MakeBsp(entities, other, entitiesLast=False):
+    fd, fileName = mkstemp(suffix='.bsp')
+    header = BSP_HEADER.size + 8
+    if entitiesLast:
+        offsets = (header + len(other), header)
+    else:
+        offsets = (header, header + len(entities))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(BSP_HEADER.pack(struct.pack('<i', 29), offsets[0],
+                                len(entities)))
+        f.write(struct.pack('<ii', offsets[1], len(other)))
+        if entitiesLast:
+            f.write(other + entities)
+        else:
+            f.write(entities + other)
+    return fileName
+
+
+# Return the entities lump and the other lump of a .bsp file
+def ReadBsp(fileName):
+    with open(fileName, 'rb') as f:
+        data = f.read()
+    version, offset, length = BSP_HEADER.unpack_from(data)
+    otherOffset, otherLength = \
+        struct.unpack_from('<ii', data, BSP_HEADER.size)
+    return data[offset:offset+length], \
+        data[otherOffset:otherOffset+otherLength]
+
+
+class ParseMapTest(unittest.TestCase):
+
+    def test_entities(self):
+        entities = ParseMap(MAP_CODE)
+        self.assertEqual(len(entities), 3)
+        self.assertEqual(entities[1][0],
+                         [('classname', 'func_door'),
+                          ('message', 'Two\nlines { }')])
+        self.assertEqual(len(entities[1][1]), 1)
+        self.assertEqual(entities[2][0][1], ('light', '2'))
+
+
+    def test_invalid(self):
+        for code in ['{\n"classname"\n}\n', '{\n{\n{\n',
+                     '"classname" "worldspawn"\n', '{\n( 0 0 0 )\n}\n']:
+            self.assertEqual(ParseMap(code), None)
+
+
+    def test_lump(self):
+        lump = EntityLump(ParseMap(MAP_CODE))
+        self.assertTrue(lump.endswith('}\n\0'))
+        self.assertTrue('"message" "Two\nlines { }"\n"model" "*1"\n'
+                        in lump)
+        self.assertEqual(lump.count('"model"'), 1)
+
+
+    def test_geometry(self):
+        entities = ParseMap(MAP_CODE)
+        moved = ParseMap(MAP_CODE.replace('10 10 10', '20 20 20'))
+        self.assertEqual(MapGeometry(entities), MapGeometry(moved))
+        self.assertNotEqual(MapGeometry(entities, lit=True),
+                            MapGeometry(moved, lit=True))
+
+
+class PatchEntityLumpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fileName = None
+
+
+    def tearDown(self):
+        if self.fileName is not None:
+            os.remove(self.fileName)
+
+
+    def test_in_place(self):
+        self.fileName = MakeBsp('{\n"a" "long value"\n}\n\0', 'x'*8)
+        self.assertTrue(PatchEntityLump(self.fileName, '{\n}\n\0'))
+        self.assertEqual(ReadBsp(self.fileName), ('{\n}\n\0', 'x'*8))
+
+
+    def test_append(self):
+        self.fileName = MakeBsp('{\n}\n\0', 'x'*7)
+        lump = '{\n"a" "longer value"\n}\n\0'
+        self.assertTrue(PatchEntityLump(self.fileName, lump))
+        self.assertEqual(ReadBsp(self.fileName), (lump, 'x'*7))
+        offset = BSP_HEADER.unpack_from(open(self.fileName, 'rb').read())[1]
+        self.assertEqual(offset % 4, 0)
+
+
+    def test_last_lump(self):
+        self.fileName = MakeBsp('{\n}\n\0', 'x'*8, entitiesLast=True)
+        for lump in ['{\n"a" "longer value"\n}\n\0', '{\n}\n\0']:
+            self.assertTrue(PatchEntityLump(self.fileName, lump))
+            self.assertEqual(ReadBsp(self.fileName), (lump, 'x'*8))
+            self.assertEqual(os.path.getsize(self.fileName),
+                             BSP_HEADER.size + 8 + 8 + len(lump))
+
+
+    def test_unsupported(self):
+        self.fileName = MakeBsp('{\n}\n\0', 'x'*8)
+        with open(self.fileName, 'r+b') as f:
+            f.write('IBSP')
+        self.assertFalse(PatchEntityLump(self.fileName, '{\n}\n\0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#*************************************************
+# test_cache.py
+#
+# Tests of the build artifacts cache. Run them with
+#   python -m unittest discover tests
+#*************************************************
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from quakehordes import ArtifactCache
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Private cache root, and work dir for the artifacts
+        self.root = mkdtemp()
+        self.oldRoot = os.environ.get('QUAKEHORDES_CACHE')
+        os.environ['QUAKEHORDES_CACHE'] = os.path.join(self.root,
+                                                       'cache')
+        self.baseName = os.path.join(self.root, 'map')
+
+
+    def tearDown(self):
+        if self.oldRoot is None:
+            del os.environ['QUAKEHORDES_CACHE']
+        else:
+            os.environ['QUAKEHORDES_CACHE'] = self.oldRoot
+        shutil.rmtree(self.root)
+
+
+    def write(self, ext, data):
+        with open(self.baseName + '.' + ext, 'wb') as f:
+            f.write(data)
+
+
+    def read(self, ext):
+        with open(self.baseName + '.' + ext, 'rb') as f:
+            return f.read()
+
+
+    # Store an entry of size bytes, used at the given time
+    def store(self, cache, key, size, mtime):
+        self.write('bsp', 'x'*size)
+        cache.store(key, self.baseName)
+        os.utime(os.path.join(cache.cacheDir, key), (mtime, mtime))
+
+
+    def test_restore(self):
+        cache = ArtifactCache('bsp', ('bsp', 'lit'))
+        self.write('bsp', 'bsp data')
+        self.write('lit', 'lit data')
+        cache.store('a', self.baseName)
+        os.remove(self.baseName + '.lit')
+        self.write('bsp', 'other data')
+
+        self.assertTrue(cache.contains('a'))
+        self.assertTrue(cache.restore('a', self.baseName))
+        self.assertEqual((self.read('bsp'), self.read('lit')),
+                         ('bsp data', 'lit data'))
+
+        # Artifacts missing from the entry are removed
+        self.write('bsp', 'bsp data')
+        os.remove(self.baseName + '.lit')
+        cache.store('b', self.baseName)
+        self.write('lit', 'lit data')
+        self.assertTrue(cache.restore('b', self.baseName))
+        self.assertFalse(os.path.exists(self.baseName + '.lit'))
+
+
+    def test_counters(self):
+        cache = ArtifactCache('bsp', ('bsp',))
+        self.assertFalse(cache.contains('a'))
+        self.assertFalse(cache.restore('a', self.baseName))
+        cache.missed()
+        self.write('bsp', 'data')
+        cache.store('a', self.baseName)
+        self.assertTrue(cache.contains('a'))
+        self.assertTrue(cache.restore('a', self.baseName))
+        self.assertTrue(cache.restore('a', self.baseName))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions),
+                         (2, 2, 0))
+
+
+    def test_eviction(self):
+        cache = ArtifactCache('bsp', ('bsp',), maxSize=250)
+        self.store(cache, 'a', 100, 1000)
+        self.store(cache, 'b', 100, 2000)
+        # Restoring an entry marks it as recently used
+        self.assertTrue(cache.restore('a', self.baseName))
+        self.store(cache, 'c', 100, 3000)
+        self.assertEqual([cache.contains(key) for key in 'abc'],
+                         [True, False, True])
+        self.assertEqual(cache.evictions, 1)
+
+        # Entries bigger than the cache are evicted at once
+        self.write('bsp', 'x'*300)
+        cache.store('d', self.baseName)
+        self.assertEqual([cache.contains(key) for key in 'acd'],
+                         [False, False, False])
+        self.assertEqual(cache.evictions, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
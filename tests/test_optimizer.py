@@ -0,0 +1,76 @@
+#*************************************************
+# test_optimizer.py
+#
+# Tests of the AST optimizer: the optimized sources
+# must compute the same values. Run them with
+#   python -m unittest discover tests
+#*************************************************
+import unittest
+
+from quakehordes import QHDLCompiler, QHDLValueError
+
+
+FOLD_CODE = '''Horde h;
+h.x = 2*3+1;
+h.y = 7/2;
+'''
+
+# a is an alias of h: assigning a.x in the loop changes h.x,
+# so h.x*2 must not be hoisted. No fireY field is assigned in
+# the loop
+HOIST_CODE = '''Horde h;
+h.x = 1;
+h.y = 0;
+Horde g;
+g.fireY = 4;
+Horde a;
+a = h;
+for each i in (0, 3):
+  a.x = a.x + 1;
+  h.y = h.y + h.x*2;
+  h.fireX = h.fireX + g.fireY*2 + i;
+end for
+'''
+
+
+# Compile a source and return the report of the optimizer and
+# the named fields of the named records
+def Run(code, fields, optimize=True):
+    compiler = QHDLCompiler(optimize=optimize, useCache=False)
+    env = compiler.compile(code)
+    values = [getattr(env.globalScope[name].value, attr)
+              for name, attr in fields]
+    return compiler.report, values
+
+
+class OptimizerTest(unittest.TestCase):
+
+    def test_fold(self):
+        fields = [('h', 'x'), ('h', 'y')]
+        report, values = Run(FOLD_CODE, fields)
+        self.assertEqual(report, ['2:6: folded [2*3] into [6]',
+                                  '2:6: folded [6+1] into [7]',
+                                  '3:6: folded [7/2] into [3]'])
+        self.assertEqual(values, [7, 3])
+        self.assertEqual(values, Run(FOLD_CODE, fields, False)[1])
+
+
+    def test_no_fold(self):
+        # Divisions by zero are left to the execution
+        compiler = QHDLCompiler(useCache=False)
+        self.assertRaises(QHDLValueError, compiler.compile,
+                          'Horde h;\nh.x = 1/0*0 + 5;\n')
+        self.assertEqual(compiler.report, [])
+
+
+    def test_hoist(self):
+        fields = [('h', 'x'), ('h', 'y'), ('h', 'fireX')]
+        report, values = Run(HOIST_CODE, fields)
+        self.assertEqual(report, ['11:22: hoisted [g.fireY*2] out of the '
+                                  'loop on line 8'])
+        self.assertEqual(values, [4, 18, 27])
+        self.assertEqual(values, Run(HOIST_CODE, fields, False)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
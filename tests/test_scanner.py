@@ -0,0 +1,88 @@
+#*************************************************
+# test_scanner.py
+#
+# Tests of the hand-written scanner: it must produce
+# the tokens of the PLY lexer. Run them with
+#   python -m unittest discover tests
+#*************************************************
+import os
+import unittest
+from glob import glob
+
+from quakehordes.lexer import QHDLLexError, BuildQHDLLexer
+from quakehordes.scanner import QHDLScanner
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CODE = '''# Comment
+Map m;   m.name = "a map";
+x = 1.5*(.25 - 3) / -2;
+if x >= 1 and not x <= 2 or x != 3:
+  print x == 2, x > 0, x < 0;
+end if
+\r\nl[0] = m-id_2.index(4);
+'''
+
+
+# Return the tokens of a lexer as (type, value, lineno, lexpos)
+# tuples, and the error raised (if any) as (char, lineno, linepos)
+def Scan(lexer, code):
+    lexer.input(code)
+    tokens = []
+    try:
+        for tok in lexer:
+            tokens.append((tok.type, tok.value, tok.lineno, tok.lexpos))
+    except QHDLLexError, e:
+        return tokens, (e.token.value[0], e.lineno, e.linepos)
+    return tokens, None
+
+
+class ScannerTest(unittest.TestCase):
+
+    def assertSameTokens(self, code):
+        expected = Scan(BuildQHDLLexer(), code)
+        self.assertEqual(Scan(QHDLScanner(), code), expected)
+        return expected
+
+
+    def test_tokens(self):
+        tokens, error = self.assertSameTokens(CODE)
+        self.assertEqual(error, None)
+        self.assertEqual(tokens[0], ('TYPE', 'Map', 2, 10))
+        self.assertTrue(('REAL_VAL', .25, 3, 46) in tokens)
+
+
+    def test_samples(self):
+        for fileName in sorted(glob(os.path.join(TESTS_DIR, '*.qh'))):
+            with open(fileName, 'rb') as f:
+                tokens, error = self.assertSameTokens(f.read())
+            self.assertEqual(error, None)
+            self.assertTrue(tokens)
+
+
+    def test_errors(self):
+        for code, error in [('x = 1;\ny = $;\n', ('$', 2, 4)),
+                            ('\tx = 1;\n', ('\t', 1, 0)),
+                            ('x = "open\n', ('"', 1, 4)),
+                            ('x = 1;   @', ('@', 1, 9)),
+                            ('@', ('@', 1, 0))]:
+            self.assertEqual(self.assertSameTokens(code)[1], error)
+
+
+    def test_file(self):
+        fileName = os.path.join(TESTS_DIR, 'test1.qh')
+        scanner = QHDLScanner()
+        scanner.inputFile(fileName)
+        try:
+            tokens = [(tok.type, tok.value, tok.lineno, tok.lexpos)
+                      for tok in scanner]
+        finally:
+            scanner.close()
+        with open(fileName, 'rb') as f:
+            self.assertEqual((tokens, None),
+                             Scan(BuildQHDLLexer(), f.read()))
+
+
+if __name__ == '__main__':
+    unittest.main()